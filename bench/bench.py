@@ -0,0 +1,224 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from os.path import abspath, dirname, exists, join
+
+from mockserver import MockServer
+
+BENCHDIR = dirname(abspath(__file__))
+CHESSGRAPH = join(BENCHDIR, "..", "chessgraph.py")
+FAKEUCI = join(BENCHDIR, "fakeuci.py")
+
+# each scenario explores from the start position, against its own mock server,
+# with a concurrency of 8 and a client rate limit of 1000/s unless given
+WINDOW = ["--alpha", "-60", "--beta", "60"]
+SCENARIOS = [
+    dict(name="chessdb-d6", args=["--source", "chessdb", "--depth", "6"] + WINDOW),
+    dict(
+        name="chessdb-d8",
+        args=["--source", "chessdb", "--depth", "8"] + WINDOW,
+    ),
+    dict(
+        name="chessdb-d8-wide",
+        args=["--source", "chessdb", "--depth", "8", "--alpha", "-80", "--beta", "80"],
+    ),
+    dict(
+        name="chessdb-d7-c1",
+        args=["--source", "chessdb", "--depth", "7", "--concurrency", "1"] + WINDOW,
+    ),
+    dict(
+        name="chessdb-d8-c32",
+        args=["--source", "chessdb", "--depth", "8", "--concurrency", "32"] + WINDOW,
+    ),
+    dict(
+        name="chessdb-d7-ratelimited",
+        args=["--source", "chessdb", "--depth", "7", "--ratelimit", "200"] + WINDOW,
+        server=dict(ratelimit=100),
+    ),
+    dict(name="lichess-d6", args=["--source", "lichess", "--depth", "6"] + WINDOW),
+    dict(
+        name="engine-d5",
+        args=["--source", "engine", "--depth", "5", "--enginemaxmoves", "5"]
+        + ["--alpha", "-100", "--beta", "100"],
+    ),
+    dict(
+        name="cascade-d7",
+        args=["--source", "chessdb,engine:2", "--depth", "7", "--enginemaxmoves", "5"]
+        + WINDOW,
+        server=dict(unknown=0.3),
+    ),
+]
+
+
+def run_scenario(scenario, latency, searchtime):
+    server = MockServer(latency=latency, **scenario.get("server", {})).start()
+    try:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            statsfile = join(tmpdir, "stats.json")
+            command = [
+                sys.executable,
+                CHESSGRAPH,
+                "--concurrency",
+                "8",
+                "--ratelimit",
+                "1000",
+                *scenario["args"],
+                "--chessdburl",
+                server.url + "/cdb.php",
+                "--lichessurl",
+                server.url,
+                "--engine",
+                FAKEUCI,
+                "--cachefile",
+                join(tmpdir, "cache.db"),
+                "--no-layout",
+                "--stats",
+                statsfile,
+            ]
+            env = dict(os.environ, FAKEUCI_SEARCHTIME=str(searchtime))
+            start = time.perf_counter()
+            process = subprocess.Popen(
+                command, cwd=tmpdir, env=env, stdout=subprocess.DEVNULL
+            )
+            _, status, rusage = os.wait4(process.pid, 0)
+            wall = time.perf_counter() - start
+            process.returncode = os.waitstatus_to_exitcode(status)
+            if process.returncode != 0:
+                raise RuntimeError(
+                    "{} failed with exit code {}".format(
+                        scenario["name"], process.returncode
+                    )
+                )
+            with open(statsfile) as f:
+                stats = json.load(f)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    return dict(
+        wall=wall,
+        explore=stats["elapsed"],
+        nodes=stats["nodes"],
+        queries=stats["queries"],
+        qps=stats["queries"] / stats["elapsed"] if stats["elapsed"] else 0,
+        # ru_maxrss is in kB on Linux
+        maxrss=rusage.ru_maxrss / 1024,
+    )
+
+
+def compare(results, baseline, tolerance):
+    # returns the scenarios that regressed with respect to the baseline
+    regressions = []
+    print(
+        "{:<24} {:>8} {:>8} {:>8} {:>8} {:>10} {:>8}  {}".format(
+            "scenario", "wall", "explore", "nodes", "queries", "queries/s", "MB", ""
+        )
+    )
+    for name, result in results.items():
+        base = baseline.get(name)
+        notes = []
+        if base is not None:
+            change = result["explore"] / base["explore"] - 1 if base["explore"] else 0
+            notes.append("{:+.0%} explore time".format(change))
+            if change > tolerance:
+                notes.append("REGRESSION")
+                regressions.append(name)
+            if result["nodes"] != base["nodes"]:
+                notes.append("nodes changed from {}".format(base["nodes"]))
+        else:
+            notes.append("no baseline")
+        print(
+            "{:<24} {:>7.2f}s {:>7.2f}s {:>8} {:>8} {:>10.1f} {:>8.1f}  {}".format(
+                name,
+                result["wall"],
+                result["explore"],
+                result["nodes"],
+                result["queries"],
+                result["qps"],
+                result["maxrss"],
+                ", ".join(notes),
+            )
+        )
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description="Benchmark chessgraph against a mock chessdb and lichess server and a fake UCI engine.",
+    )
+    parser.add_argument(
+        "scenarios",
+        nargs="*",
+        help="Scenarios to run (all by default): "
+        + ", ".join(s["name"] for s in SCENARIOS),
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.02,
+        help="Latency of the responses of the mock server (s).",
+    )
+    parser.add_argument(
+        "--searchtime",
+        type=float,
+        default=0.01,
+        help="Time of a search of the fake engine (s).",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=1,
+        help="Runs of each scenario, of which the fastest is kept.",
+    )
+    parser.add_argument(
+        "--baseline",
+        type=str,
+        default=join(BENCHDIR, "baseline.json"),
+        help="Baseline results to compare against.",
+    )
+    parser.add_argument(
+        "--save",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="Store the results as the new baseline.",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="Relative increase of the exploration time reported as a regression.",
+    )
+    args = parser.parse_args()
+
+    scenarios = [
+        s for s in SCENARIOS if not args.scenarios or s["name"] in args.scenarios
+    ]
+    unknown = set(args.scenarios) - {s["name"] for s in SCENARIOS}
+    if unknown:
+        parser.error("unknown scenarios: " + ", ".join(sorted(unknown)))
+
+    results = {}
+    for scenario in scenarios:
+        runs = [
+            run_scenario(scenario, args.latency, args.searchtime)
+            for _ in range(args.repeat)
+        ]
+        results[scenario["name"]] = min(runs, key=lambda r: r["explore"])
+
+    baseline = {}
+    if exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    regressions = compare(results, baseline, args.tolerance)
+
+    if args.save:
+        with open(args.baseline, "w") as f:
+            json.dump(dict(baseline, **results), f, indent=2)
+        print("baseline saved to", args.baseline)
+    elif regressions:
+        sys.exit(1)
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+import os
+import sys
+import time
+import chess
+import chess.polyglot
+
+# a scripted UCI engine, scoring moves deterministically from the position,
+# and taking FAKEUCI_SEARCHTIME seconds for each search
+
+
+def move_score(board, move):
+    h = chess.polyglot.zobrist_hash(board)
+    return (h ^ (move.from_square * 64 + move.to_square) * 2654435761) % 201 - 100
+
+
+def best_move(board):
+    moves = list(board.legal_moves)
+    return max(moves, key=lambda m: move_score(board, m)) if moves else None
+
+
+def main():
+    searchtime = float(os.environ.get("FAKEUCI_SEARCHTIME", "0.01"))
+    board = chess.Board()
+    multipv = 1
+
+    for line in sys.stdin:
+        tokens = line.split()
+        if not tokens:
+            continue
+        command = tokens[0]
+
+        if command == "uci":
+            print("id name fakeuci")
+            print("option name MultiPV type spin default 1 min 1 max 500")
+            print("option name Threads type spin default 1 min 1 max 512")
+            print("option name Hash type spin default 16 min 1 max 33554432")
+            print("uciok", flush=True)
+        elif command == "isready":
+            print("readyok", flush=True)
+        elif command == "setoption" and tokens[2] == "MultiPV":
+            multipv = int(tokens[4])
+        elif command == "position":
+            moves = tokens.index("moves") if "moves" in tokens else len(tokens)
+            if tokens[1] == "startpos":
+                board = chess.Board()
+            else:
+                board = chess.Board(" ".join(tokens[2:moves]))
+            for move in tokens[moves + 1 :]:
+                board.push_uci(move)
+        elif command == "go":
+            depth = int(tokens[tokens.index("depth") + 1]) if "depth" in tokens else 10
+            time.sleep(searchtime)
+            moves = sorted(board.legal_moves, key=lambda m: -move_score(board, m))
+            for i, move in enumerate(moves[:multipv]):
+                pv = [move]
+                line = board.copy()
+                line.push(move)
+                for _ in range(4):
+                    reply = best_move(line)
+                    if reply is None:
+                        break
+                    pv.append(reply)
+                    line.push(reply)
+                print(
+                    "info depth {} multipv {} score cp {} pv {}".format(
+                        depth,
+                        i + 1,
+                        move_score(board, move),
+                        " ".join(m.uci() for m in pv),
+                    )
+                )
+            print("bestmove {}".format(moves[0].uci() if moves else "0000"), flush=True)
+        elif command == "quit":
+            break
+
+
+if __name__ == "__main__":
+    main()
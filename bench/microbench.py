@@ -0,0 +1,163 @@
+import argparse
+import json
+import subprocess
+import sys
+import tempfile
+import timeit
+from os.path import abspath, dirname, join
+
+import chess
+import chess.polyglot
+
+from mockserver import MockServer
+
+BENCHDIR = dirname(abspath(__file__))
+CHESSGRAPH = join(BENCHDIR, "..", "chessgraph.py")
+sys.path.insert(0, join(BENCHDIR, ".."))
+
+from chessgraph import ChessGraph  # noqa: E402
+
+# the CPU cost of expanding a node: an exploration answered entirely from the
+# cache file, after a first run that filled it, and the work done per node and
+# per edge, the way it is done now and the way it was done before
+LINE = ["e4", "e5", "Nf3", "Nc6", "Bb5", "a6", "Ba4", "Nf6", "O-O", "Be7"]
+
+
+def cached_runs(depth, runs):
+    server = MockServer(latency=0).start()
+    try:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            statsfile = join(tmpdir, "stats.json")
+            command = [
+                sys.executable,
+                CHESSGRAPH,
+                "--source",
+                "chessdb",
+                "--depth",
+                str(depth),
+                "--alpha",
+                "-80",
+                "--beta",
+                "80",
+                "--concurrency",
+                "8",
+                "--ratelimit",
+                "1000",
+                "--chessdburl",
+                server.url + "/cdb.php",
+                "--cachefile",
+                join(tmpdir, "cache.db"),
+                "--no-layout",
+                "--stats",
+                statsfile,
+            ]
+            results = []
+            for run in range(runs + 1):
+                subprocess.run(
+                    command, cwd=tmpdir, stdout=subprocess.DEVNULL, check=True
+                )
+                with open(statsfile) as f:
+                    stats = json.load(f)
+                # the first run fills the cache
+                if run > 0:
+                    results.append(stats)
+    finally:
+        server.shutdown()
+        server.server_close()
+    return max(results, key=lambda s: s["nodespersecond"])
+
+
+def operations():
+    # the position after the line, its parent holding the moves that led to it
+    board = chess.Board()
+    for san in LINE:
+        board.push_san(san)
+    parent = board.copy()
+    parent.pop()
+    move = board.peek()
+    graph = ChessGraph.__new__(ChessGraph)
+
+    def key_before():
+        chess.polyglot.zobrist_hash(board)
+
+    def key_after():
+        graph.position_key(board)
+
+    def child_before():
+        child = parent.copy()
+        child.push(move)
+
+    def child_after():
+        child = parent.copy(stack=False)
+        child.push(move)
+
+    def edge_before():
+        parent.san(move)
+        parent.push(move)
+        chess.polyglot.zobrist_hash(parent)
+        parent.pop()
+
+    def edge_after():
+        parent.san_and_push(move)
+        graph.position_key(parent)
+        parent.pop()
+
+    def terminal_before():
+        board.is_checkmate()
+        board.is_stalemate()
+        board.is_insufficient_material()
+        board.can_claim_draw()
+        board.legal_moves.count()
+
+    def terminal_after():
+        board.legal_moves.count()
+        board.is_insufficient_material()
+
+    return [
+        ("position key", key_before, key_after),
+        ("child board", child_before, child_after),
+        ("edge (SAN and key)", edge_before, edge_after),
+        ("terminal status", terminal_before, terminal_after),
+    ]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description="Measure the CPU cost of the expansion of nodes, on a fully cached exploration.",
+    )
+    parser.add_argument(
+        "--depth", type=int, default=9, help="Depth of the cached exploration."
+    )
+    parser.add_argument(
+        "--runs",
+        type=int,
+        default=3,
+        help="Cached runs, of which the fastest is reported.",
+    )
+    parser.add_argument(
+        "--number",
+        type=int,
+        default=2000,
+        help="Repetitions of each timed operation.",
+    )
+    args = parser.parse_args()
+
+    print("{:<24} {:>10} {:>10} {:>8}".format("operation", "before", "after", ""))
+    for name, before, after in operations():
+        timings = [
+            min(timeit.repeat(f, number=args.number, repeat=5)) / args.number * 1e6
+            for f in (before, after)
+        ]
+        print(
+            "{:<24} {:>8.1f}us {:>8.1f}us {:>7.1f}x".format(
+                name, timings[0], timings[1], timings[0] / timings[1]
+            )
+        )
+
+    stats = cached_runs(args.depth, args.runs)
+    print(
+        "cached exploration at depth {}: {} nodes in {:.2f}s, {:.0f} nodes/s".format(
+            args.depth, stats["nodes"], stats["elapsed"], stats["nodespersecond"]
+        )
+    )
@@ -0,0 +1,140 @@
+import argparse
+import json
+import threading
+import time
+import zlib
+import chess
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib import parse
+
+
+# deterministic scores, so that runs against the mock explore the same graph
+def move_score(fen, ucimove):
+    return zlib.crc32((fen + ucimove).encode()) % 201 - 100
+
+
+def move_games(fen, ucimove):
+    h = zlib.crc32((ucimove + fen).encode())
+    return h % 50 + 5, h % 37 + 5, h % 23 + 5
+
+
+class TokenBucket:
+    def __init__(self, rate, burst=5):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    # serves chessdb queryall (at /cdb.php) and lichess explorer (at any other
+    # path) requests, after the latency of the server
+    protocol_version = "HTTP/1.1"
+    # headers and body are sent separately, which would otherwise wait for
+    # delayed acknowledgements on kept-alive connections
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        url = parse.urlparse(self.path)
+        query = parse.parse_qs(url.query)
+        time.sleep(self.server.latency)
+
+        status = 200
+        if url.path == "/cdb.php":
+            data = self.queryall(query["board"][0])
+            if self.server.limiter is not None and not self.server.limiter.take():
+                data = {"status": "rate limited exceeded"}
+        else:
+            data = self.explorer(query["fen"][0], int(query.get("moves", ["12"])[0]))
+            if self.server.limiter is not None and not self.server.limiter.take():
+                status, data = 429, {"error": "too many requests"}
+
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def queryall(self, fen):
+        # a fraction of the positions is unknown to the mock chessdb
+        if zlib.crc32(fen.encode()) % 1000 < 1000 * self.server.unknown:
+            return {"status": "unknown"}
+        moves = [
+            {"uci": move.uci(), "score": move_score(fen, move.uci())}
+            for move in chess.Board(fen).legal_moves
+        ]
+        moves.sort(key=lambda m: -m["score"])
+        return {"status": "ok", "moves": moves}
+
+    def explorer(self, fen, maxmoves):
+        moves = []
+        for move in list(chess.Board(fen).legal_moves)[:maxmoves]:
+            w, d, l = move_games(fen, move.uci())
+            moves.append({"uci": move.uci(), "white": w, "draws": d, "black": l})
+        return {
+            "white": sum(m["white"] for m in moves) + 10,
+            "draws": sum(m["draws"] for m in moves),
+            "black": sum(m["black"] for m in moves),
+            "moves": moves,
+        }
+
+
+class MockServer(ThreadingHTTPServer):
+    request_queue_size = 1024
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=0.02, ratelimit=None, unknown=0.09):
+        super().__init__(("127.0.0.1", port), MockHandler)
+        self.latency = latency
+        self.limiter = TokenBucket(ratelimit) if ratelimit else None
+        self.unknown = unknown
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}".format(self.server_address[1])
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description="A mock chessdb and lichess explorer server, serving deterministic responses.",
+    )
+    parser.add_argument("--port", type=int, default=8765, help="Port to listen on.")
+    parser.add_argument(
+        "--latency", type=float, default=0.02, help="Latency of a response (s)."
+    )
+    parser.add_argument(
+        "--ratelimit",
+        type=float,
+        help="Requests per second above which requests are rate limited.",
+    )
+    parser.add_argument(
+        "--unknown",
+        type=float,
+        default=0.09,
+        help="Fraction of the positions unknown to chessdb.",
+    )
+    args = parser.parse_args()
+
+    server = MockServer(args.port, args.latency, args.ratelimit, args.unknown)
+    print("serving on", server.url)
+    server.serve_forever()
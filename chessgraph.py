@@ -1,22 +1,1221 @@
-import requests
+import httpx
+import asyncio
 import pickle
+import sqlite3
 import platform
 import argparse
 import chess
 import chess.engine
 import chess.svg
+import chess.polyglot
+import chess.pgn
 import math
+import random
 import sys
+import time
+import queue
+import threading
+import collections
+import itertools
+import contextlib
+import contextvars
 import concurrent.futures
 import multiprocessing
+import multiprocessing.managers
+import multiprocessing.util
 import hashlib
-import cairosvg
+import io
+import struct
+import array
 import graphviz
+import os
+import re
+import html
+import json
+import xml.etree.ElementTree as ElementTree
+import cProfile
+import http.server
+import socket
+import socketserver
 from os.path import exists
 from urllib import parse
 
 
+class Stats:
+    # thread-safe counters and accumulated timings of a run
+    latencybounds = [0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = collections.Counter()
+
+    def add(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def get(self, name):
+        with self.lock:
+            return self.counters[name]
+
+    def update(self, counters):
+        # the peaks of the queues (see peak) are merged by their maximum
+        with self.lock:
+            for name, value in counters.items():
+                if name.startswith("queue."):
+                    self.counters[name] = max(self.counters[name], value)
+                else:
+                    self.counters[name] += value
+
+    def snapshot(self):
+        with self.lock:
+            return collections.Counter(self.counters)
+
+    def take(self):
+        # the counters accumulated so far, which are reset
+        with self.lock:
+            counters, self.counters = self.counters, collections.Counter()
+            return counters
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def observe(self, name, seconds):
+        # latencies are counted in buckets bounded by latencybounds
+        bucket = next((b for b in self.latencybounds if seconds <= b), math.inf)
+        with self.lock:
+            self.counters[name + ".count"] += 1
+            self.counters[name + ".seconds"] += seconds
+            self.counters["{}.le.{}".format(name, bucket)] += 1
+
+    def histogram(self, name):
+        with self.lock:
+            count = self.counters[name + ".count"]
+            return dict(
+                count=count,
+                mean=self.counters[name + ".seconds"] / count if count else 0,
+                buckets={
+                    str(b): self.counters["{}.le.{}".format(name, b)]
+                    for b in self.latencybounds + [math.inf]
+                },
+            )
+
+    def peak(self, name, value):
+        with self.lock:
+            self.counters[name] = max(self.counters[name], value)
+
+
+class EnginePool:
+    # long-lived UCI engines, checked out for one analysis at a time.
+    # Engines are started lazily (a fully cached run starts none) and
+    # replaced if they crash.
+    def __init__(self, command, size, options, stats):
+        self.command = command
+        self.size = size
+        self.options = options
+        self.stats = stats
+        self.idle = queue.LifoQueue()
+        self.engines = []
+        self.lock = threading.Lock()
+
+    def start_engine(self):
+        with self.stats.timer("engine.startup"):
+            engine = chess.engine.SimpleEngine.popen_uci(self.command)
+            if self.options:
+                engine.configure(self.options)
+            # wait for the engine to be ready (e.g. NNUE loaded, hash allocated)
+            engine.ping()
+        self.stats.add("engine.started")
+        return engine
+
+    def checkout(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self.lock:
+            start = len(self.engines) < self.size
+            if start:
+                self.engines.append(None)
+
+        if not start:
+            return self.idle.get()
+
+        try:
+            engine = self.start_engine()
+        except:
+            with self.lock:
+                self.engines.remove(None)
+            raise
+
+        with self.lock:
+            self.engines[self.engines.index(None)] = engine
+        return engine
+
+    def checkin(self, engine):
+        self.idle.put(engine)
+
+    def replace(self, engine):
+        try:
+            engine.close()
+        except:
+            pass
+
+        with self.lock:
+            self.engines.remove(engine)
+
+        self.stats.add("engine.restarts")
+
+    def analyse(self, board, limit, **kwargs):
+        # retry once on a fresh engine if the engine died during the search
+        for attempt in range(2):
+            engine = self.checkout()
+            try:
+                with self.stats.timer("engine.search"):
+                    info = engine.analyse(board, limit, **kwargs)
+            except (chess.engine.EngineTerminatedError, chess.engine.EngineError):
+                self.replace(engine)
+                if attempt == 1:
+                    raise
+                continue
+            self.stats.add("engine.searches")
+            self.checkin(engine)
+            return info
+
+    def close(self):
+        with self.lock:
+            engines, self.engines = self.engines, []
+        for engine in engines:
+            if engine is None:
+                continue
+            try:
+                engine.quit()
+            except:
+                engine.close()
+
+    @staticmethod
+    def report(stats):
+        startup = stats.get("engine.startup")
+        search = stats.get("engine.search")
+        print(
+            "engine startup    :  {:.2f}s ({} started, {} restarted)".format(
+                startup,
+                stats.get("engine.started"),
+                stats.get("engine.restarts"),
+            )
+        )
+        print(
+            "engine search     :  {:.2f}s ({} searches, {:.1f}% of engine time)".format(
+                search,
+                stats.get("engine.searches"),
+                100 * search / (startup + search) if startup + search > 0 else 0,
+            )
+        )
+
+
+# set in the tasks of prefetches, whose requests give way to the others
+speculative_fetch = contextvars.ContextVar("speculative_fetch", default=False)
+
+
+class RateLimiter:
+    # token bucket for the requests to a remote source. The rate adapts to the
+    # service: it is halved whenever the service reports throttling, and grows
+    # back slowly (up to the configured maximum) as requests succeed. The
+    # requests already in flight when the rate is halved were sent at the old
+    # rate, their throttling does not halve it again. Speculative requests
+    # only take a token when no other request is waiting for one.
+    def __init__(self, maxrate):
+        self.maxrate = maxrate
+        self.minrate = min(1.0, maxrate)
+        self.rate = maxrate
+        self.tokens = 1.0
+        self.updated = time.monotonic()
+        self.decreased = float("-inf")
+        self.waiting = 0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, speculative=False):
+        if speculative:
+            while True:
+                while self.waiting:
+                    await asyncio.sleep(1 / self.rate)
+                async with self.lock:
+                    if not self.waiting:
+                        return await self.take()
+
+        self.waiting += 1
+        try:
+            async with self.lock:
+                return await self.take()
+        finally:
+            self.waiting -= 1
+
+    async def take(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(
+                max(1.0, self.rate), self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return now
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def throttled(self, sent):
+        # sent is the time acquire returned for the throttled request
+        if sent < self.decreased:
+            return
+        self.decreased = time.monotonic()
+        self.rate = max(self.minrate, self.rate / 2)
+        self.tokens = min(self.tokens, 0)
+
+    def succeeded(self):
+        self.rate = min(self.maxrate, self.rate + self.maxrate / 100)
+
+
+class HttpFetcher:
+    # asynchronous HTTP client for the remote sources. Connections are kept
+    # alive in a pool sized to the concurrency, so that many requests can be in
+    # flight on the event loop without an OS thread each. The pool is split over
+    # several clients, as the cost of assigning a request to a connection grows
+    # with the number of connections of a client.
+    shardsize = 8
+
+    def __init__(self, concurrency, http2=False):
+        self.concurrency = concurrency
+        self.http2 = http2
+        self.clients = []
+        self.requests = 0
+
+    async def get_json(self, url, timeout):
+        if not self.clients:
+            # created lazily, on the event loop that uses them
+            shards = 1 if self.http2 else -(-self.concurrency // self.shardsize)
+            connections = -(-self.concurrency // shards)
+            context = httpx.create_ssl_context()
+            self.clients = [
+                httpx.AsyncClient(
+                    verify=context,
+                    http2=self.http2,
+                    limits=httpx.Limits(
+                        max_connections=connections,
+                        max_keepalive_connections=connections,
+                    ),
+                )
+                for i in range(shards)
+            ]
+        self.requests += 1
+        client = self.clients[self.requests % len(self.clients)]
+        # waiting for a free connection of the pool does not count as a timeout
+        response = await client.get(url, timeout=httpx.Timeout(timeout, pool=None))
+        response.raise_for_status()
+        return response.json()
+
+    async def close(self):
+        clients, self.clients = self.clients, []
+        for client in clients:
+            await client.aclose()
+
+
+class PositionCache:
+    # on-disk store of computed move lists, backed by SQLite.
+    # Entries are looked up on demand and committed as soon as they are stored,
+    # so an interrupted run keeps everything it computed. In WAL mode several
+    # threads (each with its own connection) and processes can share the file.
+    def __init__(self, filename):
+        self.filename = filename
+        self.local = threading.local()
+        self.connections = []
+        self.lock = threading.Lock()
+        self.connection().execute(
+            "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB)"
+        )
+
+    def connection(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(
+                self.filename, timeout=60, isolation_level=None, check_same_thread=False
+            )
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+            with self.lock:
+                self.connections.append(conn)
+        return conn
+
+    @staticmethod
+    def encode_key(key):
+        # keys are tuples of strings and ints, for which repr is canonical
+        return repr(key)
+
+    @staticmethod
+    def encode_value(value):
+        # move lists are stored as the bytes of their arrays, so that stored
+        # values only hold builtin types, whether PackedMoves was defined by
+        # the script or by the imported module
+        def encode(moves):
+            if isinstance(moves, PackedMoves):
+                return ("PackedMoves",) + moves.__getstate__()
+            return moves
+
+        if isinstance(value, list) and value and "moves" in value[0]:
+            value = [dict(e, moves=encode(e["moves"])) for e in value]
+        return pickle.dumps(encode(value), pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def decode_value(data):
+        def decode(moves):
+            if isinstance(moves, tuple) and moves[:1] == ("PackedMoves",):
+                return PackedMoves.from_state(moves[1:])
+            return moves
+
+        value = decode(pickle.loads(data))
+        if isinstance(value, list) and value and "moves" in value[0]:
+            value = [dict(e, moves=decode(e["moves"])) for e in value]
+        return value
+
+    def get(self, key, default=None):
+        row = (
+            self.connection()
+            .execute("SELECT value FROM cache WHERE key = ?", (self.encode_key(key),))
+            .fetchone()
+        )
+        return default if row is None else self.decode_value(row[0])
+
+    def __contains__(self, key):
+        row = (
+            self.connection()
+            .execute("SELECT 1 FROM cache WHERE key = ?", (self.encode_key(key),))
+            .fetchone()
+        )
+        return row is not None
+
+    def __getitem__(self, key):
+        value = self.get(key, self)
+        if value is self:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.connection().execute(
+            "INSERT OR REPLACE INTO cache (key, value) VALUES (?, ?)",
+            (self.encode_key(key), self.encode_value(value)),
+        )
+
+    def __len__(self):
+        return self.connection().execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+    def update(self, entries):
+        conn = self.connection()
+        with conn:
+            conn.execute("BEGIN")
+            conn.executemany(
+                "INSERT OR REPLACE INTO cache (key, value) VALUES (?, ?)",
+                ((self.encode_key(k), self.encode_value(v)) for k, v in entries),
+            )
+
+    def clear(self):
+        self.connection().execute("DELETE FROM cache")
+
+    def migrate(self, picklefile):
+        # import the whole-dict pickle used by earlier versions
+        with open(picklefile, "rb") as f:
+            entries = pickle.load(f)
+
+        # engine analyses were keyed by (epd, engine, depth, multipv), they are
+        # now grouped as a list of analyses under (epd, engine)
+        analyses = collections.defaultdict(list)
+        for key in [k for k in entries if len(k) == 4 and k[1] != "lichess"]:
+            epd, engine, depth, multipv = key
+            analyses[(epd, engine)].append(
+                {"depth": depth, "multipv": multipv, "moves": entries.pop(key)}
+            )
+
+        self.update(
+            [(k, PackedMoves.coerce(v)) for k, v in entries.items()]
+            + [(k, PackedMoves.coerce(v)) for k, v in analyses.items()]
+        )
+        return len(entries) + sum(len(a) for a in analyses.values())
+
+    def compact(self, unknownttl):
+        # drop entries that recorded failed lookups (empty move lists, and
+        # unknown positions past their time to live), store the move lists of
+        # earlier versions in the current format and reclaim the free space of
+        # the database file
+        conn = self.connection()
+        removed = 0
+        now = time.time()
+        for key, data in conn.execute("SELECT key, value FROM cache").fetchall():
+            value = self.decode_value(data)
+            if isinstance(value, float):
+                if now - value >= unknownttl:
+                    conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+                    removed += 1
+                continue
+            if not value:
+                conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+                removed += 1
+                continue
+            encoded = self.encode_value(PackedMoves.coerce(value))
+            if encoded != data:
+                conn.execute("UPDATE cache SET value = ? WHERE key = ?", (encoded, key))
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        conn.execute("VACUUM")
+        return removed
+
+    def info(self):
+        # number of move lists and moves stored, with the size of the stored
+        # values compared to the lists of dicts used by earlier versions
+        info = collections.Counter()
+        for (value,) in self.connection().execute("SELECT value FROM cache"):
+            info["entries"] += 1
+            info["bytes"] += len(value)
+            value = self.decode_value(value)
+            if not isinstance(value, (list, PackedMoves)):
+                continue
+            packed = PackedMoves.coerce(value)
+            if isinstance(packed, list):
+                lists = [e["moves"] for e in packed]
+                legacy = [dict(e, moves=e["moves"].as_dicts()) for e in packed]
+            else:
+                lists = [packed]
+                legacy = packed.as_dicts()
+            info["movelists"] += len(lists)
+            info["moves"] += sum(len(m) for m in lists)
+            info["legacybytes"] += len(pickle.dumps(legacy, pickle.HIGHEST_PROTOCOL))
+            info["packedbytes"] += len(self.encode_value(packed))
+        return info
+
+    def close(self):
+        with self.lock:
+            connections, self.connections = self.connections, []
+        for conn in connections:
+            conn.close()
+        self.local = threading.local()
+
+
+class PackedMoves:
+    # the scored moves of a position, sorted by decreasing score and packed in
+    # arrays: 16 bits per move (from, to, promotion), 16 bits per score and,
+    # optionally, the white/draw/black game counts of each move. Moves are
+    # decoded lazily, iterating yields (score, chess.Move) pairs.
+    __slots__ = ("moves", "scores", "wdl")
+
+    def __init__(self, items=(), wdl=None):
+        # items are (score, uci) pairs, wdl the matching (w, d, l) counts
+        order = sorted(range(len(items)), key=lambda i: -items[i][0])
+        self.moves = array.array(
+            "H", (self.encode(chess.Move.from_uci(items[i][1])) for i in order)
+        )
+        self.scores = array.array(
+            "h", (max(-32767, min(32767, int(items[i][0]))) for i in order)
+        )
+        self.wdl = None
+        if wdl is not None:
+            self.wdl = array.array("I", (c for i in order for c in wdl[i]))
+
+    @staticmethod
+    def encode(move):
+        return move.from_square | move.to_square << 6 | (move.promotion or 0) << 12
+
+    @staticmethod
+    def decode(code):
+        return chess.Move(code & 63, code >> 6 & 63, code >> 12 or None)
+
+    @classmethod
+    def coerce(cls, value):
+        # move lists cached by earlier versions are lists of dicts, also as
+        # the moves of the analyses of an engine
+        if not isinstance(value, list) or not value:
+            return value
+        if "moves" in value[0]:
+            return [dict(e, moves=cls.coerce(e["moves"])) for e in value]
+        return cls([(m["score"], m["uci"]) for m in value])
+
+    def __len__(self):
+        return len(self.moves)
+
+    def __iter__(self):
+        decode = self.decode
+        for code, score in zip(self.moves, self.scores):
+            yield score, decode(code)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            packed = PackedMoves()
+            packed.moves = self.moves[index]
+            packed.scores = self.scores[index]
+            if self.wdl is not None:
+                packed.wdl = array.array(
+                    "I",
+                    (
+                        c
+                        for i in range(len(self.moves))[index]
+                        for c in self.wdl[3 * i : 3 * i + 3]
+                    ),
+                )
+            return packed
+        return self.scores[index], self.decode(self.moves[index])
+
+    def __getstate__(self):
+        return (
+            self.moves.tobytes(),
+            self.scores.tobytes(),
+            None if self.wdl is None else self.wdl.tobytes(),
+        )
+
+    def __setstate__(self, state):
+        self.moves = array.array("H", state[0])
+        self.scores = array.array("h", state[1])
+        self.wdl = None if state[2] is None else array.array("I", state[2])
+
+    @classmethod
+    def from_state(cls, state):
+        packed = cls.__new__(cls)
+        packed.__setstate__(state)
+        return packed
+
+    def as_dicts(self):
+        # the representation used by earlier versions, to compare footprints
+        return [{"score": score, "uci": move.uci()} for score, move in self]
+
+
+class BookVisitor(chess.pgn.BaseVisitor):
+    # collects the positions and moves of the first plies of a game, moves
+    # past those are not parsed
+    def __init__(self, plies):
+        self.plies = plies
+        self.moves = []
+        self.outcome = None
+        self.valid = True
+
+    def visit_header(self, tagname, tagvalue):
+        if tagname == "Result":
+            self.outcome = {
+                "1-0": chess.WHITE,
+                "0-1": chess.BLACK,
+                "1/2-1/2": None,
+            }.get(tagvalue, "unknown")
+
+    def begin_variation(self):
+        return chess.pgn.SKIP
+
+    def parse_san(self, board, san):
+        if len(self.moves) >= self.plies:
+            return chess.Move.null()
+        return board.parse_san(san)
+
+    def visit_move(self, board, move):
+        if len(self.moves) < self.plies:
+            self.moves.append(
+                (
+                    chess.polyglot.zobrist_hash(board),
+                    PackedMoves.encode(move),
+                    board.turn,
+                )
+            )
+
+    def handle_error(self, error):
+        self.valid = False
+
+    def result(self):
+        return self
+
+
+class BookIndex:
+    # on-disk index of the moves played from a position, with the number of
+    # games won, drawn and lost by the side to move, keyed by Zobrist hash.
+    # PGN files are indexed incrementally (games appended to a file already
+    # indexed are added by the next run) and in parallel, by chunks of games.
+    chunksize = 1 << 20
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.conn = sqlite3.connect(
+            filename, timeout=60, isolation_level=None, check_same_thread=False
+        )
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS moves (key INTEGER, move INTEGER,"
+            " w INTEGER, d INTEGER, l INTEGER, PRIMARY KEY (key, move)) WITHOUT ROWID"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS files (name TEXT PRIMARY KEY, offset INTEGER)"
+        )
+
+    @staticmethod
+    def encode_key(key):
+        # Zobrist hashes are unsigned, SQLite integers signed
+        return key - (1 << 64) if key >= 1 << 63 else key
+
+    def lookup(self, key):
+        return self.conn.execute(
+            "SELECT move, w, d, l FROM moves WHERE key = ?", (self.encode_key(key),)
+        ).fetchall()
+
+    def add(self, name, offset, counts):
+        # counts are (key, move, w, d, l), added to the index together with
+        # the offset up to which the file is indexed
+        with self.conn:
+            self.conn.execute("BEGIN")
+            self.conn.executemany(
+                "INSERT INTO moves VALUES (?, ?, ?, ?, ?) ON CONFLICT (key, move) DO"
+                " UPDATE SET w = w + excluded.w, d = d + excluded.d, l = l + excluded.l",
+                counts,
+            )
+            self.conn.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?)", (name, offset)
+            )
+
+    def indexed(self, name):
+        row = self.conn.execute(
+            "SELECT offset FROM files WHERE name = ?", (name,)
+        ).fetchone()
+        return 0 if row is None else row[0]
+
+    def index(self, filename, plies, processes):
+        # returns the number of bytes of the file newly indexed
+        name = os.path.abspath(filename)
+        start = self.indexed(name)
+        size = os.path.getsize(filename)
+        if start >= size:
+            return 0
+
+        if filename.endswith(".bin"):
+            self.add(name, size, self.polyglot_counts(filename))
+            return size - start
+
+        # chunks start at a game, i.e. at a tag following an empty line
+        bounds = [start]
+        with open(filename, "rb") as f:
+            while bounds[-1] + self.chunksize < size:
+                f.seek(bounds[-1] + self.chunksize)
+                previous = f.readline()
+                while True:
+                    offset = f.tell()
+                    line = f.readline()
+                    if not line or (line.startswith(b"[") and not previous.strip()):
+                        break
+                    previous = line
+                if not line:
+                    break
+                bounds.append(offset)
+        bounds.append(size)
+
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=processes, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            chunks = executor.map(
+                self.pgn_counts,
+                [filename] * (len(bounds) - 1),
+                bounds[:-1],
+                bounds[1:],
+                [plies] * (len(bounds) - 1),
+            )
+            # chunks complete in order, an interrupted run resumes after the
+            # last chunk added
+            for end, counts in zip(bounds[1:], chunks):
+                self.add(name, end, counts)
+
+        return size - start
+
+    @staticmethod
+    def pgn_counts(filename, start, end, plies):
+        with open(filename, "rb") as f:
+            f.seek(start)
+            pgn = io.StringIO(f.read(end - start).decode("utf-8", errors="replace"))
+
+        counts = collections.defaultdict(lambda: [0, 0, 0])
+        while True:
+            game = chess.pgn.read_game(pgn, Visitor=lambda: BookVisitor(plies))
+            if game is None:
+                break
+            if not game.valid or game.outcome == "unknown":
+                continue
+            for key, move, turn in game.moves:
+                if game.outcome is None:
+                    counts[(key, move)][1] += 1
+                elif game.outcome == turn:
+                    counts[(key, move)][0] += 1
+                else:
+                    counts[(key, move)][2] += 1
+
+        return [
+            (BookIndex.encode_key(key), move, w, d, l)
+            for (key, move), (w, d, l) in counts.items()
+        ]
+
+    @staticmethod
+    def polyglot_counts(filename):
+        # Polyglot books hold weights rather than results: the weight of a
+        # move counts as wins, the mean weight of the other moves as losses
+        weights = collections.defaultdict(dict)
+        with chess.polyglot.open_reader(filename) as reader:
+            for entry in reader:
+                move = PackedMoves.encode(entry.move)
+                weights[entry.key][move] = (
+                    weights[entry.key].get(move, 0) + entry.weight
+                )
+
+        counts = []
+        for key, moves in weights.items():
+            total = sum(moves.values())
+            for move, weight in moves.items():
+                others = (total - weight) // max(1, len(moves) - 1)
+                counts.append((BookIndex.encode_key(key), move, weight, 0, others))
+        return counts
+
+    def close(self):
+        self.conn.close()
+
+
+class BoardImages:
+    # content-addressed store of the svg images of boards. Images are rendered
+    # in worker processes once the graph is written, and the least recently
+    # used ones are evicted when the store grows beyond its size.
+    poolthreshold = 16
+
+    def __init__(self, directory, maxbytes):
+        self.directory = directory
+        self.maxbytes = maxbytes
+
+    def filename(self, epd):
+        digest = hashlib.sha256(epd.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, "node-" + digest + ".svg")
+
+    def render(self, images, processes):
+        # images maps the filenames used by the graph to their positions
+        os.makedirs(self.directory, exist_ok=True)
+        missing = [f for f in images if not exists(f)]
+        if len(missing) < self.poolthreshold or processes == 1:
+            for filename in missing:
+                self.render_board(images[filename], filename)
+        else:
+            with concurrent.futures.ProcessPoolExecutor(
+                max_workers=processes, mp_context=multiprocessing.get_context("spawn")
+            ) as executor:
+                list(
+                    executor.map(
+                        self.render_board,
+                        [images[f] for f in missing],
+                        missing,
+                        chunksize=8,
+                    )
+                )
+        for filename in images:
+            os.utime(filename)
+        return len(missing), self.evict(images)
+
+    @staticmethod
+    def render_board(epd, filename):
+        import cairosvg
+
+        tmpfilename = "{}.{}.tmp".format(filename, os.getpid())
+        cairosvg.svg2svg(
+            bytestring=chess.svg.board(chess.Board(epd), size="200px").encode("utf-8"),
+            write_to=tmpfilename,
+        )
+        os.replace(tmpfilename, filename)
+
+    def evict(self, images):
+        # images in use are never evicted
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.startswith("node-") and entry.name.endswith(".svg"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        evicted = 0
+        for _, size, path in sorted(entries):
+            if total <= self.maxbytes:
+                break
+            if path in images:
+                continue
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+            total -= size
+            evicted += 1
+        return evicted
+
+    @staticmethod
+    def embed(svg, images):
+        # inlines the boards of the image elements of the graph, defining the
+        # pieces and the empty boards they share only once
+        defs = {}
+        seen = set()
+        frames = {}
+
+        def inline(match):
+            attrs = dict(re.findall(r'([\w:-]+)="([^"]*)"', match.group(0)))
+            epd = images.get(html.unescape(attrs.get("xlink:href", "")))
+            if epd is None:
+                return match.group(0)
+            board = chess.svg.board(chess.Board(epd), size="200px")
+            viewbox = re.search(r'viewBox="([^"]*)"', board).group(1)
+            pieces, _, body = board.partition("<defs>")[2].partition("</defs>")
+            # each board only defines the pieces it shows
+            if pieces not in seen:
+                seen.add(pieces)
+                for element in ElementTree.fromstring("<defs>" + pieces + "</defs>"):
+                    defs.setdefault(
+                        element.get("id"),
+                        ElementTree.tostring(element, encoding="unicode"),
+                    )
+            frame, uses, rest = body.partition("<use ")
+            frameid = frames.setdefault(frame, "board-frame-{}".format(len(frames)))
+            return (
+                '<svg x="{}" y="{}" width="{}" height="{}" viewBox="{}" '
+                'preserveAspectRatio="{}"><use href="#{}" xlink:href="#{}" />{}{}'
+            ).format(
+                attrs["x"],
+                attrs["y"],
+                attrs["width"],
+                attrs["height"],
+                viewbox,
+                attrs.get("preserveAspectRatio", "xMidYMid meet"),
+                frameid,
+                frameid,
+                uses,
+                rest,
+            )
+
+        svg = re.sub(r"<image [^>]*/>", inline, svg)
+        shared = "<defs>{}{}</defs>".format(
+            "".join(defs.values()),
+            "".join('<g id="{}">{}</g>'.format(i, f) for f, i in frames.items()),
+        )
+        root = re.search(r"<svg[^>]*>", svg)
+        return svg[: root.end()] + shared + svg[root.end() :]
+
+
+class JsonLinesSink:
+    # streams the nodes and edges of the graph as JSON objects, one per line.
+    # Nodes are written as they complete. A node expanded by several paths is
+    # written for each, in any order: the record with the highest priority
+    # ([depth, pv, path], compared as lists) holds, with the edges of the same
+    # priority from that node, as in the drawn graph (see write_graph).
+    def __init__(self, file):
+        self.file = file
+
+    def node(self, key, fields, priority):
+        self.write(
+            dict(
+                type="node",
+                id="{:016x}".format(key),
+                **fields,
+                priority=self.priority(priority),
+            )
+        )
+
+    def edge(self, keyfrom, keyto, fields, priority):
+        self.write(
+            dict(
+                type="edge",
+                source="{:016x}".format(keyfrom),
+                target="{:016x}".format(keyto),
+                **fields,
+                priority=self.priority(priority),
+            )
+        )
+
+    @staticmethod
+    def priority(priority):
+        depth, pv, path = priority
+        return [depth, pv, list(path)]
+
+    def write(self, record):
+        self.file.write(json.dumps(record, separators=(",", ":")) + "\n")
+
+    def end(self):
+        pass
+
+    def close(self):
+        self.end()
+        self.file.close()
+
+
+class GraphMLSink:
+    # writes the nodes and edges of the graph as GraphML elements. Elements
+    # must be unique, so the body is written at the end, from the records of
+    # the highest priority expansion of each node (as in write_graph).
+    nodekeys = [
+        ("epd", "string"),
+        ("score", "int"),
+        ("pv", "boolean"),
+        ("depth", "int"),
+    ]
+    edgekeys = [
+        ("san", "string"),
+        ("uci", "string"),
+        ("score", "int"),
+        ("pv", "boolean"),
+        ("late", "boolean"),
+    ]
+
+    def __init__(self, file):
+        self.file = file
+        self.nodes = {}
+        self.edges = {}
+        self.file.write(
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<graphml xmlns="http://graphml.graphdrawing.org/xmlns">\n'
+        )
+        for domain, keys in [("node", self.nodekeys), ("edge", self.edgekeys)]:
+            for name, kind in keys:
+                self.file.write(
+                    '<key id="{}.{}" for="{}" attr.name="{}" attr.type="{}"/>\n'.format(
+                        domain, name, domain, name, kind
+                    )
+                )
+        self.file.write('<graph id="ChessGraph" edgedefault="directed">\n')
+
+    def data(self, domain, fields):
+        return "".join(
+            '<data key="{}.{}">{}</data>'.format(
+                domain,
+                name,
+                html.escape(str(value).lower() if kind == "boolean" else str(value)),
+            )
+            for name, kind in (self.nodekeys if domain == "node" else self.edgekeys)
+            if (value := fields[name]) is not None
+        )
+
+    def node(self, key, fields, priority):
+        if key not in self.nodes or self.nodes[key][0] < priority:
+            self.nodes[key] = (priority, fields)
+
+    def edge(self, keyfrom, keyto, fields, priority):
+        # the edges of a node come from the expansion of the node
+        if keyfrom not in self.edges or self.edges[keyfrom][0] < priority:
+            self.edges[keyfrom] = (priority, {})
+        if self.edges[keyfrom][0] == priority:
+            self.edges[keyfrom][1][keyto] = fields
+
+    def end(self):
+        for key, (priority, fields) in self.nodes.items():
+            self.file.write(
+                '<node id="{:016x}">{}</node>\n'.format(key, self.data("node", fields))
+            )
+        for keyfrom, (priority, edges) in self.edges.items():
+            for keyto, fields in edges.items():
+                self.file.write(
+                    '<edge source="{:016x}" target="{:016x}">{}</edge>\n'.format(
+                        keyfrom, keyto, self.data("edge", fields)
+                    )
+                )
+        self.nodes, self.edges = {}, {}
+        self.file.write("</graph>\n</graphml>\n")
+
+    def close(self):
+        self.end()
+        self.file.close()
+
+
+def open_sink(filename):
+    # the format of an exported graph follows from its extension
+    if filename.endswith(".jsonl"):
+        return JsonLinesSink(open(filename, "w", encoding="utf-8"))
+    elif filename.endswith(".graphml"):
+        return GraphMLSink(open(filename, "w", encoding="utf-8"))
+    else:
+        raise ValueError("unknown export format: " + filename)
+
+
+class TranspositionTable:
+    # the priority with which each node of the graph was claimed, sharded over
+    # several locked tables so that concurrent explorations can claim nodes
+    # with little contention. Claiming is atomic: a node is expanded by the
+    # exploration with the highest priority (see Node), whatever the order in
+    # which they arrive.
+    def __init__(self, shards=64):
+        self.shards = [({}, threading.Lock()) for i in range(shards)]
+
+    def shard(self, key):
+        return self.shards[hash(key) % len(self.shards)]
+
+    def claim(self, key, priority):
+        # false if the node was claimed before with at least the same priority
+        table, lock = self.shard(key)
+        with lock:
+            claimed = table.get(key)
+            if claimed is not None and claimed >= priority:
+                return False
+            table[key] = priority
+            return True
+
+    def claimable(self, key, priority):
+        table, lock = self.shard(key)
+        with lock:
+            claimed = table.get(key)
+            return claimed is None or claimed < priority
+
+    def clear(self):
+        for table, lock in self.shards:
+            with lock:
+                table.clear()
+
+
+class Budget:
+    # limits on the work of an exploration: the number of nodes expanded, of
+    # queries sent to the source and the time spent. Once it is exhausted,
+    # the nodes left in the frontier become leaves.
+    def __init__(self, maxnodes=None, maxqueries=None, timelimit=None):
+        self.maxnodes = maxnodes
+        self.maxqueries = maxqueries
+        self.timelimit = timelimit
+        self.lock = threading.Lock()
+        self.nodes = 0
+        self.queries = 0
+        self.start = time.time()
+
+    def restart(self):
+        with self.lock:
+            self.nodes = 0
+            self.queries = 0
+            self.start = time.time()
+
+    def exhausted(self):
+        return (
+            (self.maxnodes is not None and self.nodes >= self.maxnodes)
+            or (self.maxqueries is not None and self.queries >= self.maxqueries)
+            or (
+                self.timelimit is not None
+                and time.time() - self.start >= self.timelimit
+            )
+        )
+
+    def expand(self):
+        # counts a node to be expanded, unless the budget is exhausted
+        with self.lock:
+            if self.exhausted():
+                return False
+            self.nodes += 1
+            return True
+
+    def query(self):
+        with self.lock:
+            self.queries += 1
+
+    def counts(self):
+        with self.lock:
+            return self.nodes, self.queries
+
+    def limited(self):
+        return any(
+            limit is not None
+            for limit in [self.maxnodes, self.maxqueries, self.timelimit]
+        )
+
+    def summary(self):
+        def used(value, limit):
+            return value if limit is None else "{}/{}".format(value, limit)
+
+        with self.lock:
+            return "{} nodes, {} queries, {}s".format(
+                used(self.nodes, self.maxnodes),
+                used(self.queries, self.maxqueries),
+                used("{:.1f}".format(time.time() - self.start), self.timelimit),
+            )
+
+
+class ExplorationManager(multiprocessing.managers.BaseManager):
+    # serves the state shared by the processes of an exploration
+    pass
+
+
+ExplorationManager.register("TranspositionTable", TranspositionTable)
+ExplorationManager.register("Budget", Budget)
+
+
+class Expansion:
+    # what the expansion of a node computed, replayed when the node is reached
+    # again by the same path (in a deeper iteration, or a resumed run): its
+    # score and moves, and the SAN and position key of the children found
+    __slots__ = ("path", "epd", "bestscore", "moves", "legalmoves", "edges")
+
+    def __init__(self, path, epd, bestscore, moves, legalmoves):
+        self.path = path
+        self.epd = epd
+        self.bestscore = bestscore
+        self.moves = moves
+        self.legalmoves = legalmoves
+        self.edges = []
+
+
+class Node:
+    # a position in the frontier of the exploration. A position reached by
+    # several paths is expanded for the deepest, then for a PV node, then for
+    # the first in move order. The path holds the (negated) indices of its
+    # moves, so that the priority of an earlier path compares higher.
+    # Nodes are expanded closest to the PV first: by their rank, the number
+    # of moves off the PV and the score given up along their path. The board
+    # of a node replayed from an expansion is only set up when needed, and
+    # without its move stack: repetitions are found from the position keys
+    # of the nodes along the path.
+    __slots__ = (
+        "key",
+        "poskey",
+        "board",
+        "depth",
+        "alpha",
+        "beta",
+        "pvNode",
+        "plyFromRoot",
+        "parent",
+        "edgescore",
+        "path",
+        "priority",
+        "rank",
+        "move",
+        "pending",
+        "finalize",
+    )
+
+    def __init__(
+        self,
+        key,
+        poskey,
+        board,
+        depth,
+        alpha,
+        beta,
+        pvNode,
+        plyFromRoot,
+        parent,
+        edgescore=None,
+        path=(),
+        rank=(0, 0),
+        move=None,
+    ):
+        self.key = key
+        self.poskey = poskey
+        self.board = board
+        self.depth = depth
+        self.alpha = alpha
+        self.beta = beta
+        self.pvNode = pvNode
+        self.plyFromRoot = plyFromRoot
+        self.parent = parent
+        self.edgescore = edgescore
+        self.path = path
+        self.priority = (depth, pvNode, path)
+        self.rank = rank
+        self.move = move
+        self.pending = 0
+        self.finalize = None
+
+
 class ChessGraph:
+    # the bitboards, castling rights, turn and en passant square of a position
+    positionstruct = struct.Struct("<9Q2B")
+
     def __init__(
         self,
         networkstyle,
@@ -29,136 +1228,560 @@ class ChessGraph:
         enginemaxmoves,
         boardstyle,
         boardedges,
+        enginethreads=None,
+        enginehash=None,
+        http2=False,
+        chessdburl="http://www.chessdb.cn/cdb.php",
+        lichessurl="https://explorer.lichess.ovh",
+        ratelimit=50,
+        retries=5,
+        unknownttl=86400,
+        leafeval="search",
+        pvharvest=0,
+        prefetch=0,
+        processes=0,
+        lichessbeta=None,
+        book="chessgraph.book.db",
+        boardcache="chessgraph.boards",
+        boardcachesize=100,
+        bookmingames=10,
+        maxnodes=None,
+        maxqueries=None,
+        timelimit=None,
+        iterative=False,
+        checkpoint=None,
+        progress=False,
+        profile=None,
+        exports=(),
+        layout=True,
+        simplify=False,
+        layoutthreshold=5000,
+        largelayout="sfdp",
     ):
+        # the arguments, from which the graphs of worker processes are created
+        self.options = {k: v for k, v in locals().items() if k != "self"}
         self.networkstyle = networkstyle
         self.depth = depth
         self.source = source
+        # a source is a cascade of tiers (e.g. "chessdb,engine:4"), tried in
+        # turn until one scores the position, each with a concurrency limit
+        self.sources = []
+        self.tierlimits = {}
+        for tier in source.split(","):
+            name, _, limit = tier.partition(":")
+            self.sources.append(name)
+            self.tierlimits[name] = int(limit) if limit else concurrency
         self.lichessdb = lichessdb
         self.engine = engine
         self.enginedepth = enginedepth
         self.enginemaxmoves = enginemaxmoves
         self.boardstyle = boardstyle
+        self.boardimages = BoardImages(boardcache, boardcachesize * 1024 * 1024)
+        self.images = {}
         self.boardedges = boardedges
-
-        self.executorgraph = [
-            concurrent.futures.ThreadPoolExecutor(max_workers=concurrency)
-            for i in range(0, depth + 1)
-        ]
+        self.chessdburl = chessdburl
+        self.lichessurl = lichessurl
+        self.retries = retries
+        self.unknownttl = unknownttl
+        self.leafeval = leafeval
+        self.pvharvest = pvharvest
+
+        # the exploration runs on the event loop, with one worker per source
+        # request in flight. Engine searches block, and run in the executor.
+        self.concurrency = concurrency
         self.executorwork = concurrent.futures.ThreadPoolExecutor(
             max_workers=concurrency
         )
-        self.visited = set()
-        self.session = requests.Session()
+        self.tt = TranspositionTable()
+        self.nodeids = {}
+        self.nodeidslock = threading.Lock()
+        self.records = []
+        self.iterative = iterative
+        self.checkpoint = checkpoint
+        self.progress = progress
+        self.profiler = cProfile.Profile() if profile is not None else None
+        self.profile = profile
+        self.elapsed = 0
+        self.exports = exports
+        self.sinks = []
+        self.layout = layout
+        self.simplify = simplify
+        self.layoutthreshold = layoutthreshold
+        self.largelayout = largelayout
+        self.collapsed = 0
+        self.resumed = False
+        self.expansions = {}
+        self.roots = 0
+        self.written = None
+        # the position keys before the root, nearest first
+        self.history = ()
+
+        # subtrees can be explored by worker processes (see explore_subtree),
+        # sharing the cache and the nodes already claimed
+        self.processes = processes
+        self.processpool = None
+        self.budget = Budget(maxnodes, maxqueries, timelimit)
+        if processes > 1:
+            self.manager = ExplorationManager(ctx=multiprocessing.get_context("spawn"))
+            self.manager.start()
+            self.tt = self.manager.TranspositionTable()
+            self.budget = self.manager.Budget(maxnodes, maxqueries, timelimit)
+
+        # event loop (in a background thread) on which the remote sources are queried
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        self.fetcher = HttpFetcher(concurrency + prefetch, http2)
+        self.inflight = {}
+        self.prefetchlimit = prefetch
+        self.prefetching = 0
+        self.prefetched = set()
+        self.prefetchtasks = {}
+        self.ratelimiters = {
+            "chessdb": RateLimiter(ratelimit),
+            "lichess": RateLimiter(ratelimit),
+        }
         self.graph = graphviz.Digraph("ChessGraph", format="svg")
         self.cache = {}
-
-        # We fix lichessbeta by giving the startpos a score of 0.35
-        if self.source == "lichess":
-            w, d, l, moves = self.lichess_api_call(
-                "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq -"
+        self.stats = Stats()
+
+        engineoptions = {}
+        if enginethreads is not None:
+            engineoptions["Threads"] = enginethreads
+        if enginehash is not None:
+            engineoptions["Hash"] = enginehash
+        # with worker processes, the engines only run in the workers
+        self.enginepool = None
+        if processes <= 1:
+            self.enginepool = EnginePool(
+                engine,
+                self.tierlimits.get("engine", concurrency),
+                engineoptions,
+                self.stats,
             )
-            self.lichessbeta = (1 - 0.35) / math.log((w + d + l) / w - 1)
+        # the entries of a position are updated by the executor threads of
+        # both analyses and harvests, each update rereads them under the lock
+        self.enginecachelock = threading.Lock()
+        self.tiersemaphores = {
+            name: asyncio.Semaphore(limit) for name, limit in self.tierlimits.items()
+        }
+
+        self.book = BookIndex(book) if "book" in self.sources else None
+        self.bookmingames = bookmingames
+
+        # We fix lichessbeta by giving the startpos a score of 0.35, as scored
+        # by the first of lichess and the book in the cascade
+        self.lichessbeta = lichessbeta
+        scaled = [name for name in self.sources if name in ["lichess", "book"]]
+        if lichessbeta is not None or not scaled:
+            pass
+        elif scaled[0] == "book":
+            wdl = self.book_wdl(chess.Board()).values()
+            w, d, l = [sum(c[i] for c in wdl) for i in range(3)]
+            # books without results from the startpos (Polyglot) are not scaled
+            self.lichessbeta = 1.0
+            if 0 < w < d + l:
+                self.lichessbeta = (1 - 0.35) / math.log((w + d + l) / w - 1)
         else:
-            self.lichessbeta = None
+            result = self.run(
+                self.lichess_api_call(
+                    "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq -"
+                )
+            )
+            if result is None:
+                raise RuntimeError("Could not query the lichess explorer.")
+            w, d, l, moves = result
+            self.lichessbeta = (1 - 0.35) / math.log((w + d + l) / w - 1)
 
-    def load_cache(self):
+    def run(self, coro):
+        # run a coroutine on the event loop, and wait for its result
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def close(self):
+        if self.processpool is not None:
+            self.processpool.shutdown(cancel_futures=True)
+            self.processpool = None
+        if self.processes > 1:
+            # the counts of the shared budget remain available for the stats
+            budget = Budget(
+                self.options["maxnodes"],
+                self.options["maxqueries"],
+                self.options["timelimit"],
+            )
+            budget.nodes, budget.queries = self.budget.counts()
+            self.budget = budget
+            self.manager.shutdown()
+        if self.enginepool is not None:
+            self.enginepool.close()
+        if self.book is not None:
+            self.book.close()
+        self.run(self.fetcher.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        if isinstance(self.cache, PositionCache):
+            self.cache.close()
+
+    def report(self):
+        if self.budget.limited():
+            print(
+                "budget used       :  {}, {} leaves".format(
+                    self.budget.summary(), self.stats.get("budgetleaves")
+                )
+            )
+        print(
+            "nodes expanded    :  {}, {:.0f} nodes/s".format(
+                self.stats.get("nodes"),
+                self.stats.get("nodes") / self.elapsed if self.elapsed else 0,
+            )
+        )
+        print("coalesced fetches : ", self.stats.get("coalesced"))
+        print("leaves from edges : ", self.stats.get("leafscores"))
+        if self.iterative or self.checkpoint is not None:
+            print("replayed nodes    : ", self.stats.get("replayed"))
+        if self.prefetchlimit > 0:
+            print(
+                "prefetches        :  {} issued, {} skipped, {} used, {} failed".format(
+                    self.stats.get("prefetch.issued"),
+                    self.stats.get("prefetch.skipped"),
+                    self.stats.get("prefetch.used"),
+                    self.stats.get("prefetch.failed"),
+                )
+            )
+        if len(self.sources) > 1:
+            print(
+                "scored by tier    : ",
+                ", ".join(
+                    "{} {}".format(self.stats.get("tier." + name), name)
+                    for name in self.sources + ["none"]
+                ),
+            )
+        for source in self.sources:
+            if source == "engine":
+                print(
+                    "engine cache      :  {} hits, {} provisional hits, {} harvested".format(
+                        self.stats.get("engine.cachehits"),
+                        self.stats.get("engine.provisionalhits"),
+                        self.stats.get("engine.harvested"),
+                    )
+                )
+                EnginePool.report(self.stats)
+            elif source == "book":
+                print(
+                    "book lookups      :  {} ok, {} unknown".format(
+                        self.stats.get("book.ok"), self.stats.get("book.unknown")
+                    )
+                )
+            else:
+                print(
+                    "{:<18}: ".format(source + " queries"),
+                    ", ".join(
+                        "{} {}".format(self.stats.get(source + "." + outcome), outcome)
+                        for outcome in [
+                            "ok",
+                            "unknown",
+                            "ratelimited",
+                            "timeouts",
+                            "errors",
+                            "retries",
+                            "failed",
+                            "cachedunknown",
+                        ]
+                    ),
+                )
+
+    def open_cache(self, filename, purge=False, legacy="chessgraph.cache.pyc"):
+        migrate = not exists(filename) and exists(legacy)
+        self.cache = PositionCache(filename)
+
+        if purge:
+            self.cache.clear()
+        elif migrate:
+            print("migrated entries  : ", self.cache.migrate(legacy))
+
+    async def get_moves(self, epd):
+        # concurrent requests for the same position share a single fetch. A
+        # request for a prefetched position counts as its use, and waits for
+        # the prefetch, finding the moves of the first tier in the cache.
+        if epd in self.prefetched:
+            self.prefetched.discard(epd)
+            self.stats.add("prefetch.used")
+            prefetch = self.prefetchtasks.get(epd)
+            if prefetch is not None:
+                await asyncio.shield(prefetch)
+
+        pending = self.inflight.get(epd)
+        if pending is not None:
+            self.stats.add("coalesced")
+            return await asyncio.shield(pending)
+
+        pending = self.inflight[epd] = self.loop.create_future()
         try:
-            with open("chessgraph.cache.pyc", "rb") as f:
-                self.cache = pickle.load(f)
-        except:
-            self.cache = {}
-
-    def store_cache(self):
-        with open("chessgraph.cache.pyc", "wb") as f:
-            pickle.dump(self.cache, f)
-
-    def get_moves(self, epd):
-        if self.source == "chessdb":
-            return self.get_moves_chessdb(epd)
-        elif self.source == "engine":
-            return self.get_moves_engine(epd)
-        elif self.source == "lichess":
-            return self.get_moves_lichess(epd)
+            moves = await self.fetch_moves(epd)
+        except Exception as e:
+            pending.set_exception(e)
+            pending.exception()  # not an error if nobody else was waiting
+            raise
+        else:
+            pending.set_result(moves)
+        finally:
+            del self.inflight[epd]
+
+        return moves
+
+    async def fetch_moves(self, epd):
+        # the tiers of the source are tried in turn, each caching its moves
+        # in its own namespace, until one scores the position
+        for source in self.sources:
+            async with self.tiersemaphores[source]:
+                start = time.perf_counter()
+                moves = await self.fetch_tier_moves(source, epd)
+                self.stats.observe("latency." + source, time.perf_counter() - start)
+            if moves:
+                break
+        else:
+            source = "none"
+
+        if len(self.sources) > 1:
+            self.stats.add("tier." + source)
+        return moves
+
+    async def fetch_tier_moves(self, source, epd):
+        if source == "chessdb":
+            return await self.get_moves_chessdb(epd)
+        elif source == "engine":
+            if self.enginepool is None:
+                moves, counters = await self.loop.run_in_executor(
+                    self.subtree_pool(), analyse_in_process, epd
+                )
+                self.stats.update(counters)
+                return moves
+            return await self.loop.run_in_executor(
+                self.executorwork, self.get_moves_engine, epd
+            )
+        elif source == "lichess":
+            return await self.get_moves_lichess(epd)
+        elif source == "book":
+            return self.get_moves_book(epd)
         else:
             assert False
 
-    def get_bestscore_and_moves(self, board):
-        if board.is_checkmate():
+    async def get_bestscore_and_moves(
+        self, board, leafscore=None, legalmoves=None, repeated=False
+    ):
+        if legalmoves is None:
+            legalmoves = board.legal_moves.count()
+        if legalmoves == 0:
             moves = []
-            bestscore = -30000
+            bestscore = -30000 if board.is_check() else 0
         elif (
-            board.is_stalemate()
-            or board.is_insufficient_material()
-            or board.can_claim_draw()
+            board.is_insufficient_material() or board.halfmove_clock >= 100 or repeated
         ):
             moves = []
             bestscore = 0
+        elif leafscore is not None:
+            # a leaf scored without querying the source
+            moves = []
+            bestscore = leafscore
         else:
-            moves = self.executorwork.submit(self.get_moves, board.epd()).result()
-            if self.source != "chessdb":
-                moves.sort(key=lambda item: item["score"], reverse=True)
-            bestscore = int(moves[0]["score"]) if moves else None
+            moves = await self.get_moves(board.epd())
+            bestscore = int(moves[0][0]) if moves else None
         return bestscore, moves
 
-    def get_moves_engine(self, epd):
-        key = (epd, self.engine, self.enginedepth, self.enginemaxmoves)
+    @staticmethod
+    def engine_entry_covers(entry, depth, multipv):
+        # an analysis answers any request of lower or equal depth and MultiPV,
+        # also for larger MultiPV if it already lists all legal moves
+        return entry["depth"] >= depth and (
+            entry["multipv"] >= multipv or len(entry["moves"]) < entry["multipv"]
+        )
 
-        if key in self.cache:
-            return self.cache[key]
+    def get_moves_engine(self, epd):
+        # all analyses of a position by an engine share one key, the entry
+        # holds those analyses that are not covered by another one
+        key = (epd, self.engine)
+
+        # provisional entries, harvested from principal variations, only
+        # provide a score (see get_provisional_score)
+        entries = PackedMoves.coerce(self.cache.get(key, []))
+        for entry in entries:
+            if entry.get("provisional"):
+                continue
+            if self.engine_entry_covers(entry, self.enginedepth, self.enginemaxmoves):
+                self.stats.add("engine.cachehits")
+                return entry["moves"][: self.enginemaxmoves]
+        self.stats.add("engine.cachemisses")
+
+        # an analysis that is too shallow is refreshed, keeping its MultiPV
+        multipv = max(
+            [self.enginemaxmoves]
+            + [
+                e["multipv"]
+                for e in entries
+                if e["depth"] < self.enginedepth and not e.get("provisional")
+            ]
+        )
 
-        moves = []
-        engine = chess.engine.SimpleEngine.popen_uci(self.engine)
         board = chess.Board(epd)
-        info = engine.analyse(
+        self.budget.query()
+        info = self.enginepool.analyse(
             board,
             chess.engine.Limit(depth=self.enginedepth),
-            multipv=self.enginemaxmoves,
+            multipv=multipv,
             info=chess.engine.INFO_SCORE | chess.engine.INFO_PV,
         )
-        engine.quit()
-        for i in info:
-            moves.append(
-                {
-                    "score": i["score"].pov(board.turn).score(mate_score=30000),
-                    "uci": chess.Move.uci(i["pv"][0]),
-                }
-            )
+        moves = PackedMoves(
+            [
+                (
+                    i["score"].pov(board.turn).score(mate_score=30000),
+                    chess.Move.uci(i["pv"][0]),
+                )
+                for i in info
+            ]
+        )
 
-        self.cache[key] = moves
+        entry = {"depth": self.enginedepth, "multipv": multipv, "moves": moves}
+        with self.enginecachelock:
+            entries = PackedMoves.coerce(self.cache.get(key, []))
+            self.cache[key] = [entry] + [
+                e
+                for e in entries
+                if not self.engine_entry_covers(entry, e["depth"], e["multipv"])
+            ]
 
-        return moves
+        if self.pvharvest > 0:
+            self.harvest_pvs(board, info)
 
-    def get_moves_chessdb(self, epd):
-        key = (epd, "chessdb")
+        return moves[: self.enginemaxmoves]
 
-        if key in self.cache:
-            stdmoves = self.cache[key]
-            if len(stdmoves) > 0:
-                return stdmoves
+    def harvest_pvs(self, board, info):
+        # the positions along each principal variation are recorded as
+        # provisional entries: the best move and score at that position, good
+        # for the search depth minus the number of plies into the PV
+        for i in info:
+            pv = i.get("pv", [])
+            score = i["score"].pov(board.turn).score(mate_score=30000)
+            child = board.copy(stack=False)
+            for ply in range(1, min(len(pv), self.pvharvest + 1)):
+                child.push(pv[ply - 1])
+                score = -score
+                entry = {
+                    "depth": self.enginedepth - ply,
+                    "multipv": 1,
+                    "moves": PackedMoves([(score, pv[ply].uci())]),
+                    "provisional": True,
+                }
 
-        api = "http://www.chessdb.cn/cdb.php"
-        url = api + "?action=queryall&board=" + parse.quote(epd) + "&json=1"
+                key = (child.epd(), self.engine)
+                with self.enginecachelock:
+                    entries = PackedMoves.coerce(self.cache.get(key, []))
+                    if any(
+                        self.engine_entry_covers(e, entry["depth"], 1) for e in entries
+                    ):
+                        continue
+                    self.cache[key] = entries + [entry]
+                self.stats.add("engine.harvested")
+
+    def get_provisional_score(self, epd):
+        # score of a position for which only a score is needed (a leaf), taken
+        # from any entry deep enough, provisional or not
+        for entry in PackedMoves.coerce(self.cache.get((epd, self.engine), [])):
+            if entry["depth"] >= self.enginedepth - self.pvharvest and entry["moves"]:
+                self.stats.add("engine.provisionalhits")
+                return entry["moves"][0][0]
+        return None
+
+    async def query(self, source, url, throttled=lambda data: False):
+        # query a remote source, respecting its rate limit and retrying with
+        # exponential backoff (and jitter) on throttling, timeouts and errors.
+        # Returns the decoded response, or None if all attempts failed.
+        limiter = self.ratelimiters[source]
         timeout = 3
+        self.budget.query()
+
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                self.stats.add(source + ".retries")
+                backoff = min(30, 0.5 * 2 ** (attempt - 1))
+                await asyncio.sleep(backoff * random.uniform(0.5, 1.5))
+
+            sent = await limiter.acquire(speculative_fetch.get())
+            try:
+                data = await self.fetcher.get_json(url, timeout)
+            except httpx.TimeoutException:
+                self.stats.add(source + ".timeouts")
+                continue
+            except httpx.HTTPStatusError as e:
+                if e.response.status_code == 429:
+                    self.stats.add(source + ".ratelimited")
+                    limiter.throttled(sent)
+                else:
+                    self.stats.add(source + ".errors")
+                continue
+            except (httpx.HTTPError, ValueError):
+                self.stats.add(source + ".errors")
+                continue
+
+            if throttled(data):
+                self.stats.add(source + ".ratelimited")
+                limiter.throttled(sent)
+                continue
+
+            limiter.succeeded()
+            return data
+
+        self.stats.add(source + ".failed")
+        return None
+
+    def is_known_unknown(self, key, source):
+        # positions the source recently did not know are not queried again
+        # until their negative cache entry expires
+        seen = self.cache.get(key + ("unknown",))
+        if seen is not None and time.time() - seen < self.unknownttl:
+            self.stats.add(source + ".cachedunknown")
+            return True
+        return False
+
+    def tier_key(self, source, epd):
+        # the cache key of the moves of a remote source
+        if source == "chessdb":
+            return (epd, "chessdb")
+        return (epd, "lichess", self.enginemaxmoves, self.lichessdb)
+
+    async def get_moves_chessdb(self, epd):
+        key = self.tier_key("chessdb", epd)
+
+        stdmoves = PackedMoves.coerce(self.cache.get(key))
+        if stdmoves:
+            self.stats.add("chessdb.cachehits")
+            return stdmoves
+        self.stats.add("chessdb.cachemisses")
+
+        if self.is_known_unknown(key, "chessdb"):
+            return PackedMoves()
+
+        url = self.chessdburl + "?action=queryall&board=" + parse.quote(epd) + "&json=1"
+
+        data = await self.query(
+            "chessdb",
+            url,
+            throttled=lambda data: data.get("status") == "rate limited exceeded",
+        )
 
-        moves = []
-        try:
-            response = self.session.get(url, timeout=timeout)
-            response.raise_for_status()
-            data = response.json()
-            if data["status"] == "ok":
-                moves = data["moves"]
-            elif data["status"] == "unknown":
-                pass
-            elif data["status"] == "rate limited exceeded":
-                sys.stderr.write("rate")
-            else:
-                sys.stderr.write(data)
-        except:
-            pass
+        # a failed query is not cached, the position will be queried again later
+        if data is None:
+            return PackedMoves()
 
-        stdmoves = []
-        for m in moves:
-            stdmoves.append({"score": m["score"], "uci": m["uci"]})
+        # only positions chessdb does not know are cached as such, other
+        # statuses may be transient
+        if data.get("status") == "unknown":
+            self.stats.add("chessdb.unknown")
+            self.cache[key + ("unknown",)] = time.time()
+            return PackedMoves()
+        if data.get("status") != "ok":
+            self.stats.add("chessdb.errors")
+            return PackedMoves()
+
+        self.stats.add("chessdb.ok")
+
+        stdmoves = PackedMoves([(m["score"], m["uci"]) for m in data["moves"]])
 
         self.cache[key] = stdmoves
 
@@ -185,7 +1808,7 @@ class ChessGraph:
                 -10000, -int(100 - 100 * self.lichessbeta * math.log(total / l - 1))
             )
 
-    def lichess_api_call(self, epd):
+    async def lichess_api_call(self, epd):
         if self.lichessdb == "masters":
             specifics = "&topGames=0"
         else:
@@ -197,41 +1820,47 @@ class ChessGraph:
             )
 
         url = (
-            "https://explorer.lichess.ovh/{}?".format(self.lichessdb)
+            "{}/{}?".format(self.lichessurl, self.lichessdb)
             + specifics
             + "&moves={}".format(self.enginemaxmoves)
             + "&fen={}".format(parse.quote(epd))
         )
 
-        timeout = 3
+        data = await self.query("lichess", url)
 
-        try:
-            response = self.session.get(url, timeout=timeout)
-            response.raise_for_status()
-            data = response.json()
+        if data is None:
+            return None
 
-            if epd.split()[1] == "w":
-                w, d, l = int(data["white"]), int(data["draws"]), int(data["black"])
-            else:
-                l, d, w = int(data["white"]), int(data["draws"]), int(data["black"])
-            moves = data["moves"]
-        except:
-            w = d = l = 0
-            moves = []
+        if epd.split()[1] == "w":
+            w, d, l = int(data["white"]), int(data["draws"]), int(data["black"])
+        else:
+            l, d, w = int(data["white"]), int(data["draws"]), int(data["black"])
+        moves = data["moves"]
 
         return (w, d, l, moves)
 
-    def get_moves_lichess(self, epd):
-        key = (epd, "lichess", self.enginemaxmoves, self.lichessdb)
+    async def get_moves_lichess(self, epd):
+        key = self.tier_key("lichess", epd)
+
+        stdmoves = PackedMoves.coerce(self.cache.get(key))
+        if stdmoves:
+            self.stats.add("lichess.cachehits")
+            return stdmoves
+        self.stats.add("lichess.cachemisses")
+
+        if self.is_known_unknown(key, "lichess"):
+            return PackedMoves()
 
-        if key in self.cache:
-            stdmoves = self.cache[key]
-            if len(stdmoves) > 0:
-                return stdmoves
+        result = await self.lichess_api_call(epd)
 
-        w, d, l, moves = self.lichess_api_call(epd)
+        # a failed query is not cached, the position will be queried again later
+        if result is None:
+            return PackedMoves()
 
-        stdmoves = []
+        w, d, l, moves = result
+
+        scored = []
+        wdl = []
         for m in moves:
             if epd.split()[1] == "w":
                 w, d, l = int(m["white"]), int(m["draws"]), int(m["black"])
@@ -242,37 +1871,94 @@ class ChessGraph:
             lichessmingames = 10
             if total > lichessmingames:
                 score = self.lichess_wdl_to_score(w, d, l)
-                stdmoves.append({"score": score, "uci": m["uci"]})
+                scored.append((score, m["uci"]))
+                wdl.append((w, d, l))
 
-        self.cache[key] = stdmoves
+        stdmoves = PackedMoves(scored, wdl)
+
+        if stdmoves:
+            self.stats.add("lichess.ok")
+            self.cache[key] = stdmoves
+        else:
+            # not enough games to score any move
+            self.stats.add("lichess.unknown")
+            self.cache[key + ("unknown",)] = time.time()
 
         return stdmoves
 
-    def node_name(self, board):
-        if self.networkstyle == "graph":
-            name = "graph - " + board.epd()
-        elif self.networkstyle == "tree":
-            movelist = []
-            while True:
-                try:
-                    move = board.pop()
-                    movelist.append(move)
-                except:
-                    break
-            name = board.epd() + " moves "
-            for move in reversed(movelist):
-                board.push(move)
-                name = name + " " + move.uci()
-        else:
-            raise ()
+    def book_wdl(self, board):
+        # the w/d/l counts of the moves of the book from a position, by move.
+        # Moves are checked for legality (e.g. for castling as stored in
+        # Polyglot books, or a hash collision) and merged.
+        moves = {}
+        for code, w, d, l in self.book.lookup(chess.polyglot.zobrist_hash(board)):
+            try:
+                ucimove = board.parse_uci(PackedMoves.decode(code).uci()).uci()
+            except ValueError:
+                continue
+            counts = moves.setdefault(ucimove, [0, 0, 0])
+            counts[0] += w
+            counts[1] += d
+            counts[2] += l
+        return moves
 
-        return name
+    def get_moves_book(self, epd):
+        # the book is local, its moves are not cached
+        self.budget.query()
+        scored = []
+        wdl = []
+        for ucimove, (w, d, l) in self.book_wdl(chess.Board(epd)).items():
+            if w + d + l >= self.bookmingames:
+                scored.append((self.lichess_wdl_to_score(w, d, l), ucimove))
+                wdl.append((w, d, l))
+
+        self.stats.add("book.ok" if scored else "book.unknown")
+        return PackedMoves(scored, wdl)
+
+    def position_key(self, board):
+        # a 64 bit hash of what identifies a position for repetitions, a lot
+        # cheaper to compute than its Zobrist hash
+        return int.from_bytes(
+            hashlib.blake2b(
+                self.positionstruct.pack(
+                    board.pawns,
+                    board.knights,
+                    board.bishops,
+                    board.rooks,
+                    board.queens,
+                    board.kings,
+                    board.occupied_co[chess.WHITE],
+                    board.occupied_co[chess.BLACK],
+                    board.clean_castling_rights(),
+                    board.turn,
+                    board.ep_square if board.has_legal_en_passant() else 64,
+                ),
+                digest_size=8,
+            ).digest(),
+            "little",
+        )
 
-    def write_node(self, board, score, showboard, pvNode, tooltip):
-        epd = board.epd()
-        nodename = self.node_name(board)
+    def node_key(self, poskey, parentkey=None):
+        # nodes are identified by the key of their position, in a tree by the
+        # path leading to them, extending the key of their parent
+        key = poskey
+        if self.networkstyle == "tree" and parentkey is not None:
+            key = ((parentkey * 0x100000001B3) ^ key) & 0xFFFFFFFFFFFFFFFF
+        return key
+
+    def node_id(self, key):
+        # short identifier of a node in the emitted graph
+        with self.nodeidslock:
+            nodeid = self.nodeids.get(key)
+            if nodeid is None:
+                nodeid = self.nodeids[key] = str(len(self.nodeids))
+            return nodeid
+
+    def write_node(self, key, priority, epd, score, showboard, pvNode, tooltip):
+        start = time.perf_counter()
+        turn = chess.WHITE if epd.split()[1] == "w" else chess.BLACK
 
-        color = "gold" if board.turn == chess.WHITE else "burlywood4"
+        color = "gold" if turn == chess.WHITE else "burlywood4"
         penwidth = "3" if pvNode else "1"
 
         epdweb = parse.quote(epd)
@@ -281,28 +1967,20 @@ class ChessGraph:
 
         if showboard and not self.boardstyle == "none":
             if self.boardstyle == "unicode":
-                label = board.unicode(empty_square="\u00B7")
+                label = chess.Board(epd).unicode(empty_square="\u00B7")
             elif self.boardstyle == "svg":
-                filename = (
-                    "node-" + hashlib.sha256(epd.encode("utf-8")).hexdigest() + ".svg"
-                )
-                if not exists(filename):
-                    cairosvg.svg2svg(
-                        bytestring=chess.svg.board(board, size="200px").encode("utf-8"),
-                        write_to=filename,
-                    )
-                image = filename
+                # rendered once the graph is written, see render
+                image = self.boardimages.filename(epd)
                 label = ""
         else:
             label = (
                 "None"
                 if score is None
-                else str(score if board.turn == chess.WHITE else -score)
+                else str(score if turn == chess.WHITE else -score)
             )
 
         if image:
-            self.graph.node(
-                nodename,
+            attrs = dict(
                 label=label,
                 shape="box",
                 color=color,
@@ -312,8 +1990,7 @@ class ChessGraph:
                 tooltip=tooltip,
             )
         else:
-            self.graph.node(
-                nodename,
+            attrs = dict(
                 label=label,
                 shape="box",
                 color=color,
@@ -322,10 +1999,28 @@ class ChessGraph:
                 URL=URL,
                 tooltip=tooltip,
             )
+        fields = dict(
+            epd=epd,
+            score=None if score is None else score if turn == chess.WHITE else -score,
+            pv=pvNode,
+            depth=priority[0],
+        )
+        self.emit(("node", (key, epd), priority, attrs, fields))
+        self.stats.add("write.node", time.perf_counter() - start)
 
     def write_edge(
-        self, nodefrom, nodeto, sanmove, ucimove, turn, score, pvEdge, lateEdge
+        self,
+        nodefrom,
+        priority,
+        nodeto,
+        sanmove,
+        ucimove,
+        turn,
+        score,
+        pvEdge,
+        lateEdge,
     ):
+        start = time.perf_counter()
         color = "gold" if turn == chess.WHITE else "burlywood4"
         penwidth = "3" if pvEdge else "1"
         fontname = "Helvetica-bold" if pvEdge else "Helvectica"
@@ -336,9 +2031,7 @@ class ChessGraph:
             "None" if score is None else str(score if turn == chess.WHITE else -score),
         )
         tooltip = labeltooltip
-        self.graph.edge(
-            nodefrom,
-            nodeto,
+        attrs = dict(
             label=sanmove,
             color=color,
             penwidth=penwidth,
@@ -348,65 +2041,278 @@ class ChessGraph:
             labeltooltip=labeltooltip,
             style=style,
         )
+        fields = dict(
+            san=sanmove,
+            uci=ucimove,
+            score=None if score is None else score if turn == chess.WHITE else -score,
+            pv=pvEdge,
+            late=lateEdge,
+        )
+        self.emit(("edge", (nodefrom, nodeto), priority, attrs, fields))
+        self.stats.add("write.edge", time.perf_counter() - start)
+
+    def emit(self, record):
+        # the records are kept for the graph laid out once exploration
+        # completes, and streamed to the exported graphs
+        kind, keys, priority, attrs, fields = record
+        if self.layout:
+            self.records.append(record)
+        for sink in self.sinks:
+            if kind == "node":
+                sink.node(keys[0], fields, priority)
+            else:
+                sink.edge(keys[0], keys[1], fields, priority)
+
+    def write_graph(self, rootkeys, records):
+        # nodes and edges are recorded by key while exploring, possibly in
+        # other processes. A node expanded several times keeps the records of
+        # its highest priority expansion, and the graph is written depth first
+        # from the roots, so that it does not depend on the order of exploration.
+        nodes = {}
+        edges = {}
+        for kind, keys, priority, attrs, fields in records:
+            if kind == "node":
+                if keys[0] not in nodes or nodes[keys[0]][0] < priority:
+                    nodes[keys[0]] = (priority, keys[1], attrs)
+            else:
+                if keys[0] not in edges or edges[keys[0]][0] < priority:
+                    edges[keys[0]] = (priority, [])
+                if edges[keys[0]][0] == priority:
+                    edges[keys[0]][1].append((keys[1], attrs))
+
+        # nodes with a single edge in and out (e.g. forced sequences) are
+        # collapsed, so that the edges of the chain become a single edge
+        collapsible = set()
+        if self.simplify:
+            indegree = collections.Counter()
+            reached = set(rootkeys)
+            stack = list(rootkeys)
+            while stack:
+                for keyto, attrs in edges.get(stack.pop(), (None, []))[1]:
+                    indegree[keyto] += 1
+                    if keyto not in reached:
+                        reached.add(keyto)
+                        stack.append(keyto)
+            collapsible = {
+                key
+                for key in reached
+                if key not in rootkeys
+                and indegree[key] == 1
+                and len(edges.get(key, (None, []))[1]) == 1
+            }
+        self.collapsed = len(collapsible)
+
+        written = set()
+
+        def write(key):
+            written.add(key)
+            for keyto, attrs in edges.get(key, (None, []))[1]:
+                chain = [attrs]
+                while keyto in collapsible:
+                    keyto, attrs = edges[keyto][1][0]
+                    chain.append(attrs)
+                if len(chain) > 1:
+                    attrs = self.chain_attrs(chain)
+                self.graph.edge(self.node_id(key), self.node_id(keyto), **attrs)
+                if keyto not in written:
+                    write(keyto)
+            if key in nodes:
+                _, epd, attrs = nodes[key]
+                if "image" in attrs:
+                    self.images[attrs["image"]] = epd
+                self.graph.node(self.node_id(key), **attrs)
+
+        self.images = {}
+        for rootkey in rootkeys:
+            if rootkey not in written:
+                write(rootkey)
+
+    def chain_attrs(self, chain):
+        # a collapsed chain is labelled by its sequence of moves, it is drawn
+        # as part of the PV only if all its edges are
+        tooltip = ", ".join(attrs["tooltip"] for attrs in chain)
+        pvEdge = all(attrs["penwidth"] == "3" for attrs in chain)
+        lateEdge = any(attrs["style"] == "dashed" for attrs in chain)
+        return dict(
+            chain[0],
+            label=" ".join(attrs["label"] for attrs in chain),
+            penwidth="3" if pvEdge else "1",
+            fontname="Helvetica-bold" if pvEdge else "Helvectica",
+            tooltip=tooltip,
+            edgetooltip=tooltip,
+            labeltooltip=tooltip,
+            style="dashed" if lateEdge else "solid",
+        )
 
-    def recurse(self, board, depth, alpha, beta, pvNode, plyFromRoot):
-        nodenamefrom = self.node_name(board)
+    def leaf_from_edge(self, depth, pvNode):
+        return depth == 0 and (
+            self.leafeval == "edge" or (self.leafeval == "edgepv" and not pvNode)
+        )
 
-        # terminate recursion if visited
-        if nodenamefrom in self.visited:
+    def prefetch(self, epd):
+        # speculative fetch of a position the exploration is likely to reach,
+        # from the first (remote) tier of the source only. The number of those
+        # in flight is bounded so they do not crowd out the fetches the
+        # exploration is waiting for.
+        if self.prefetching >= self.prefetchlimit or epd in self.inflight:
+            return
+        if epd in self.prefetchtasks or self.budget.exhausted():
+            return
+        source = self.sources[0]
+
+        async def fetch():
+            try:
+                # the exploration may have fetched the position since, a
+                # prefetch never joins its fetch
+                if epd in self.inflight or self.cache.get(self.tier_key(source, epd)):
+                    self.stats.add("prefetch.skipped")
+                    return
+                speculative_fetch.set(True)
+                self.prefetched.add(epd)
+                async with self.tiersemaphores[source]:
+                    await self.fetch_tier_moves(source, epd)
+            except Exception:
+                self.stats.add("prefetch.failed")
+            finally:
+                self.prefetching -= 1
+                del self.prefetchtasks[epd]
+
+        self.prefetching += 1
+        self.stats.add("prefetch.issued")
+        self.prefetchtasks[epd] = asyncio.ensure_future(fetch())
+
+    async def expand(self, node):
+        if self.processes > 1 and node.plyFromRoot == 2:
+            await self.expand_in_process(node)
             return
-        else:
-            self.visited.add(nodenamefrom)
 
-        bestscore, moves = self.get_bestscore_and_moves(board)
+        nodenamefrom = node.key
+
+        # terminate recursion if visited, by a path of at least the same priority
+        if not self.tt.claim(nodenamefrom, node.priority):
+            self.complete(node)
+            return
+        self.stats.add("nodes")
+
+        # nodes at depth 0 are leaves, their moves are only needed for the
+        # score, which the edge from the parent provides as well
+        leafscore = None
+        if node.edgescore is not None and self.leaf_from_edge(node.depth, node.pvNode):
+            leafscore = -node.edgescore
+            self.stats.add("leafscores")
+        elif node.depth == 0 and self.sources[0] == "engine" and self.pvharvest > 0:
+            leafscore = self.get_provisional_score(self.node_board(node).epd())
+
+        # nodes reached once the budget is exhausted are leaves as well
+        if (
+            leafscore is None
+            and node.edgescore is not None
+            and not self.budget.expand()
+        ):
+            leafscore = -node.edgescore
+            self.stats.add("budgetleaves")
+
+        # a node expanded before by the same path is replayed
+        expansion = self.expansions.get(nodenamefrom)
+        if expansion is not None and expansion.path != node.path:
+            expansion = None
+
+        if leafscore is None and expansion is not None:
+            bestscore, moves = expansion.bestscore, expansion.moves
+            epd, legalmoves = expansion.epd, expansion.legalmoves
+            self.stats.add("replayed")
+        else:
+            board = self.node_board(node)
+            epd, legalmoves = board.epd(), board.legal_moves.count()
+            bestscore, moves = await self.get_bestscore_and_moves(
+                board, leafscore, legalmoves, self.repeated(node, board.halfmove_clock)
+            )
+            expansion = None
+            # expansions are only replayed by a deeper iteration or a resumed
+            # run, and failed lookups not at all, the source is queried again
+            if (
+                (self.iterative or self.checkpoint is not None)
+                and leafscore is None
+                and bestscore is not None
+            ):
+                expansion = self.expansions[nodenamefrom] = Expansion(
+                    node.path, epd, bestscore, moves, legalmoves
+                )
 
         edgesfound = 0
         edgesdrawn = 0
-        futures = []
-        turn = board.turn
-        tooltip = board.epd() + "&#010;"
+        children = []
+        turn = chess.WHITE if epd.split()[1] == "w" else chess.BLACK
+        tooltip = [epd]
 
         # loop through the (sorted) moves that are within delta of the bestmove
-        for m in moves:
-            score = int(m["score"])
-
-            if score <= alpha:
+        for score, move in moves:
+            if score <= node.alpha:
                 break
 
-            ucimove = m["uci"]
-            move = chess.Move.from_uci(ucimove)
-            sanmove = board.san(move)
-            board.push(move)
-            nodenameto = self.node_name(board)
+            ucimove = move.uci()
+            if expansion is not None and edgesfound < len(expansion.edges):
+                sanmove, poskey = expansion.edges[edgesfound]
+            else:
+                board = self.node_board(node)
+                sanmove = board.san_and_push(move)
+                poskey = self.position_key(board)
+                board.pop()
+                if expansion is not None:
+                    expansion.edges.append((sanmove, poskey))
+            nodenameto = self.node_key(poskey, node.key)
             edgesfound += 1
-            pvEdge = pvNode and score == bestscore
+            pvEdge = node.pvNode and score == bestscore
             lateEdge = score != bestscore
 
             # no loops, otherwise recurse
             if score == bestscore:
-                newDepth = depth - 1
+                newDepth = node.depth - 1
             else:
-                newDepth = depth - int(1.5 + math.log2(edgesfound))
+                newDepth = node.depth - int(1.5 + math.log2(edgesfound))
 
             if newDepth >= 0:
-                if nodenameto not in self.visited:
-                    futures.append(
-                        self.executorgraph[depth].submit(
-                            self.recurse,
-                            board.copy(),
+                path = node.path + (-edgesfound,)
+                claimable = self.tt.claimable(nodenameto, (newDepth, pvEdge, path))
+                if (
+                    self.prefetchlimit > 0
+                    and self.sources[0] in ["chessdb", "lichess"]
+                    and not self.leaf_from_edge(newDepth, pvEdge)
+                    and claimable
+                    and nodenameto not in self.expansions
+                ):
+                    board = self.node_board(node)
+                    board.push(move)
+                    self.prefetch(board.epd())
+                    board.pop()
+                if claimable:
+                    children.append(
+                        Node(
+                            nodenameto,
+                            poskey,
+                            None,
                             newDepth,
-                            -beta,
-                            -alpha,
+                            -node.beta,
+                            -node.alpha,
                             pvEdge,
-                            plyFromRoot + 1,
+                            node.plyFromRoot + 1,
+                            node,
+                            score,
+                            path,
+                            (
+                                node.rank[0] + (score != bestscore),
+                                node.rank[1] + bestscore - score,
+                            ),
+                            move,
                         )
                     )
                 edgesdrawn += 1
-                tooltip += "{} : {}&#010;".format(
-                    sanmove, str(score if turn == chess.WHITE else -score)
+                tooltip.append(
+                    "{} : {}".format(sanmove, score if turn == chess.WHITE else -score)
                 )
                 self.write_edge(
                     nodenamefrom,
+                    node.priority,
                     nodenameto,
                     sanmove,
                     ucimove,
@@ -416,37 +2322,367 @@ class ChessGraph:
                     lateEdge,
                 )
 
-            board.pop()
-
-        concurrent.futures.wait(futures)
-
-        remainingMoves = board.legal_moves.count() - edgesdrawn
-        tooltip += "{} remaining {}&#010;".format(
-            remainingMoves, "move" if remainingMoves == 1 else "moves"
+        remainingMoves = legalmoves - edgesdrawn
+        tooltip.append(
+            "{} remaining {}".format(
+                remainingMoves, "move" if remainingMoves == 1 else "moves"
+            )
         )
 
         if edgesdrawn == 0:
-            tooltip += "terminal: {}".format(
-                "None"
-                if bestscore is None
-                else str(bestscore if turn == chess.WHITE else -bestscore)
+            tooltip.append(
+                "terminal: {}".format(
+                    "None"
+                    if bestscore is None
+                    else str(bestscore if turn == chess.WHITE else -bestscore)
+                )
             )
-
-        self.write_node(
-            board,
+        else:
+            tooltip.append("")
+        tooltip = "&#010;".join(tooltip)
+
+        # the node is written once all its children are completed
+        node.finalize = lambda: self.write_node(
+            nodenamefrom,
+            node.priority,
+            epd,
             bestscore,
             edgesdrawn >= self.boardedges
-            or (pvNode and edgesdrawn == 0)
-            or plyFromRoot == 0,
-            pvNode,
+            or (node.pvNode and edgesdrawn == 0)
+            or node.plyFromRoot == 0,
+            node.pvNode,
             tooltip,
         )
 
-    def generate_graph(self, epd, alpha, beta, ralpha, rbeta, salpha, sbeta):
+        node.pending = len(children)
+        if children:
+            for child in children:
+                self.schedule(child)
+        else:
+            self.complete(node)
+
+    def node_board(self, node):
+        if node.board is None:
+            node.board = self.node_board(node.parent).copy(stack=False)
+            node.board.push(node.move)
+        return node.board
+
+    def ancestor_keys(self, node, count):
+        # the position keys of the nearest ancestors of a node, continued by
+        # those given for the root of a subtree explored in a process
+        keys = []
+        ancestor = node.parent
+        while ancestor is not None and len(keys) < count:
+            keys.append(ancestor.poskey)
+            ancestor = ancestor.parent
+        if ancestor is None:
+            keys.extend(self.history)
+        return keys
+
+    def repeated(self, node, halfmoves):
+        # a position occurring for the third time since the last capture or
+        # pawn move, with the same side to move
+        keys = self.ancestor_keys(node, halfmoves)
+        return keys[1:halfmoves:2].count(node.poskey) >= 2
+
+    def complete(self, node):
+        # continuation run when a node and all its children are done
+        while node is not None:
+            if node.finalize is not None:
+                node.finalize()
+            node = node.parent
+            if node is not None:
+                node.pending -= 1
+                if node.pending > 0:
+                    break
+            else:
+                self.explored.set()
+
+    def schedule(self, node):
+        self.frontier.put_nowait(
+            (node.rank, node.plyFromRoot, next(self.sequence), node)
+        )
+
+    async def worker(self):
+        while True:
+            node = (await self.frontier.get())[-1]
+            try:
+                await self.expand(node)
+            except Exception as e:
+                self.failure = e
+                self.explored.set()
+                raise
+
+    def subtree_pool(self):
+        # the worker processes, sharing the concurrency and the limits of the
+        # tiers of the source
+        if self.processpool is None:
+            source = ",".join(
+                "{}:{}".format(name, max(1, self.tierlimits[name] // self.processes))
+                for name in self.sources
+            )
+            options = dict(
+                self.options,
+                source=source,
+                concurrency=max(1, self.concurrency // self.processes),
+                ratelimit=self.options["ratelimit"] / self.processes,
+                prefetch=self.options["prefetch"] // self.processes,
+                processes=0,
+                lichessbeta=self.lichessbeta,
+                layout=True,
+                # the progress line and the profile are those of the main process
+                progress=False,
+                profile=None,
+            )
+            cachefile = (
+                self.cache.filename if isinstance(self.cache, PositionCache) else None
+            )
+            self.processpool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.processes,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=init_subtree_process,
+                initargs=(options, cachefile, self.tt, self.budget),
+            )
+        return self.processpool
+
+    async def expand_in_process(self, node):
+        # the first two plies are explored here, each subtree below them by a
+        # worker process. Those workers do not count towards the concurrency.
+        state = (
+            node.key,
+            node.poskey,
+            self.ancestor_keys(node, node.plyFromRoot),
+            self.node_board(node),
+            node.depth,
+            node.alpha,
+            node.beta,
+            node.pvNode,
+            node.plyFromRoot,
+            node.edgescore,
+            node.path,
+            self.roots,
+            self.checkpoint if self.resumed else None,
+            self.networkstyle,
+            self.boardstyle,
+        )
+        (
+            records,
+            expansions,
+            counters,
+        ) = await asyncio.get_running_loop().run_in_executor(
+            self.subtree_pool(), explore_subtree, state
+        )
+        for record in records:
+            self.emit(record)
+        self.expansions.update(expansions)
+        self.stats.update(counters)
+        self.complete(node)
+
+    async def explore(self, root):
+        # expand nodes from a single frontier queue, with a fixed number of
+        # workers, until the root and all its descendants are completed
+        self.frontier = asyncio.PriorityQueue()
+        self.prefetched = set()
+        self.sequence = itertools.count()
+        self.explored = asyncio.Event()
+        self.failure = None
+        self.schedule(root)
+
+        workers = [
+            asyncio.create_task(self.worker())
+            for i in range(self.concurrency + self.processes)
+        ]
+        workers.append(asyncio.create_task(self.monitor()))
+        if self.profiler is not None:
+            self.profiler.enable()
+        start = time.perf_counter()
+        try:
+            await self.explored.wait()
+        finally:
+            self.elapsed += time.perf_counter() - start
+            if self.profiler is not None:
+                self.profiler.disable()
+            for w in workers:
+                w.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            if self.progress:
+                sys.stderr.write("\n")
+
+        if self.failure is not None:
+            raise self.failure
+
+    async def monitor(self):
+        # samples the depth of the queues, and shows the progress on stderr
+        start = time.perf_counter()
+        for tick in itertools.count():
+            self.stats.peak("queue.frontier", self.frontier.qsize())
+            self.stats.peak("queue.executor", self.executorwork._work_queue.qsize())
+            self.stats.peak("queue.inflight", len(self.inflight))
+            self.stats.peak("queue.prefetching", self.prefetching)
+            if self.progress and tick % 5 == 4:
+                elapsed = self.elapsed + time.perf_counter() - start
+                nodes, queries = self.budget.counts()
+                sys.stderr.write(
+                    "\r{} nodes, {:.0f} nodes/s, {} queries, frontier {}, "
+                    "in flight {}, {:.1f}s ".format(
+                        nodes,
+                        nodes / elapsed if elapsed > 0 else 0,
+                        queries,
+                        self.frontier.qsize(),
+                        len(self.inflight),
+                        elapsed,
+                    )
+                )
+                sys.stderr.flush()
+            await asyncio.sleep(0.1)
+
+    def write_stats(self, filename):
+        # machine readable report of the run
+        counters = self.stats.snapshot()
+        latency = {
+            source: self.stats.histogram("latency." + source) for source in self.sources
+        }
+        cache = {}
+        for source in self.sources:
+            hits = counters[source + ".cachehits"]
+            misses = counters[source + ".cachemisses"]
+            cache[source] = dict(
+                hits=hits,
+                misses=misses,
+                hitrate=hits / (hits + misses) if hits + misses else None,
+            )
+        report = dict(
+            elapsed=self.elapsed,
+            nodes=counters["nodes"],
+            queries=self.budget.counts()[1],
+            nodespersecond=counters["nodes"] / self.elapsed if self.elapsed else None,
+            cache=cache,
+            latency=latency,
+            queues={
+                name: counters["queue." + name]
+                for name in ["frontier", "executor", "inflight", "prefetching"]
+            },
+            timings={
+                name: counters[name]
+                for name in [
+                    "write.node",
+                    "write.edge",
+                    "layout",
+                    "boards",
+                    "engine.search",
+                    "engine.startup",
+                ]
+            },
+            counters={
+                name: value
+                for name, value in sorted(counters.items())
+                if not name.startswith(("latency.", "queue."))
+            },
+        )
+        with open(filename, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+    def rendering(self):
+        # the state from which the graph written last is rendered, which can
+        # be rendered while the next graph is explored
+        return self.graph, len(self.nodeids), self.collapsed, self.images
+
+    def render(self, filename, embed=False, rendering=None):
+        # generate the svg image (calls graphviz under the hood), large graphs
+        # are laid out by a faster engine than dot. Without a filename, the
+        # image is returned.
+        graph, nodes, collapsed, images = rendering or self.rendering()
+        graph.engine = self.largelayout if nodes > self.layoutthreshold else "dot"
+        if images:
+            start = time.perf_counter()
+            rendered, evicted = self.boardimages.render(
+                images, self.processes or os.cpu_count()
+            )
+            self.stats.add("boards", time.perf_counter() - start)
+            print(
+                "board images      :  {} rendered, {} cached, {} evicted, {:.2f}s".format(
+                    rendered,
+                    len(images) - rendered,
+                    evicted,
+                    time.perf_counter() - start,
+                )
+            )
+
+        start = time.perf_counter()
+        svgpiped = graph.pipe()
+        self.stats.add("layout", time.perf_counter() - start)
+        print(
+            "layout            :  {} by {}, {} nodes ({} collapsed), {:.2f}s".format(
+                filename or "response",
+                graph.engine,
+                nodes,
+                collapsed,
+                time.perf_counter() - start,
+            )
+        )
+
+        svg = svgpiped.decode("utf-8")
+        if embed:
+            svg = self.boardimages.embed(svg, images)
+        if filename is None:
+            return svg
+        with open(filename, "w", encoding="utf-8") as f:
+            f.write(svg)
+
+    def checkpoint_settings(self, board):
+        # the settings on which the expansions of a checkpoint depend, and the
+        # version of their keys
+        return (
+            2,
+            board.epd(),
+            self.networkstyle,
+            tuple(self.sources),
+            self.lichessdb,
+            self.engine,
+            self.enginedepth,
+            self.enginemaxmoves,
+            self.bookmingames,
+        )
+
+    def load_checkpoint(self, board):
+        # returns the depth and window of the last iteration of the checkpoint
+        if self.checkpoint is None or not exists(self.checkpoint):
+            return None
+        with open(self.checkpoint, "rb") as f:
+            checkpoint = pickle.load(f)
+        if checkpoint["settings"] != self.checkpoint_settings(board):
+            print("checkpoint        :  ignored, made with different settings")
+            return None
+        self.expansions = checkpoint["expansions"]
+        self.resumed = True
+        print(
+            "checkpoint        :  {} expansions, depth {}".format(
+                len(self.expansions), checkpoint["depth"]
+            )
+        )
+        return checkpoint["depth"], checkpoint["window"]
+
+    def save_checkpoint(self, board, depth, window):
+        with open(self.checkpoint + ".tmp", "wb") as f:
+            pickle.dump(
+                {
+                    "settings": self.checkpoint_settings(board),
+                    "depth": depth,
+                    "window": window,
+                    "expansions": self.expansions,
+                },
+                f,
+                pickle.HIGHEST_PROTOCOL,
+            )
+        os.replace(self.checkpoint + ".tmp", self.checkpoint)
+
+    def generate_graph(
+        self, epd, alpha, beta, ralpha, rbeta, salpha, sbeta, render=None
+    ):
         # set initial board
         board = chess.Board(epd)
 
-        score, _ = self.get_bestscore_and_moves(board)
+        score, _ = self.run(self.get_bestscore_and_moves(board))
         score = score if board.turn == chess.WHITE else -score
 
         if ralpha is not None:
@@ -469,16 +2705,380 @@ class ChessGraph:
         )
         print("depth             : ", self.depth)
 
+        self.budget.restart()
+
+        # expansions are only replayed for the root they were made from
+        self.roots += 1
+        self.expansions = {}
+        self.resumed = False
+
         if board.turn == chess.WHITE:
             initialAlpha, initialBeta = alpha, beta
         else:
             initialAlpha, initialBeta = -beta, -alpha
 
-        self.recurse(
-            board, self.depth, initialAlpha, initialBeta, pvNode=True, plyFromRoot=0
+        # iterative deepening renders the graph after each depth, skipping the
+        # depths a resumed checkpoint covered already with the same window
+        resumed = self.load_checkpoint(board)
+        first = self.depth
+        if self.iterative:
+            first = 1
+            if resumed is not None and resumed[1] == (alpha, beta):
+                first = min(resumed[0] + 1, self.depth)
+
+        for depth in range(first, self.depth + 1):
+            start = time.perf_counter()
+            expanded = self.stats.get("nodes")
+            self.tt.clear()
+            self.graph = graphviz.Digraph("ChessGraph", format="svg")
+            self.nodeids = {}
+
+            poskey = self.position_key(board)
+            root = Node(
+                self.node_key(poskey),
+                poskey,
+                board.copy(stack=False),
+                depth,
+                initialAlpha,
+                initialBeta,
+                True,
+                0,
+                None,
+            )
+            self.sinks = [open_sink(filename) for filename in self.exports]
+            try:
+                self.run(self.explore(root))
+            finally:
+                for sink in self.sinks:
+                    sink.close()
+                self.sinks = []
+            records, self.records = self.records, []
+            if self.layout:
+                self.write_graph([root.key], records)
+                self.written = (root.key, records)
+
+            if self.checkpoint is not None:
+                self.save_checkpoint(board, depth, (alpha, beta))
+
+            if self.iterative:
+                print(
+                    "iteration         :  depth {}, {} nodes, {:.2f}s".format(
+                        depth,
+                        self.stats.get("nodes") - expanded,
+                        time.perf_counter() - start,
+                    )
+                )
+                if depth < self.depth and self.budget.exhausted():
+                    break
+                if depth < self.depth and render is not None:
+                    render()
+
+        if self.profiler is not None:
+            self.profiler.dump_stats(self.profile)
+
+    def write_merged(self, written):
+        # a single graph of the roots of a batch, from their written records
+        self.graph = graphviz.Digraph("ChessGraph", format="svg")
+        self.nodeids = {}
+        self.write_graph(
+            [rootkey for rootkey, records in written],
+            [record for rootkey, records in written for record in records],
         )
 
 
+class GraphServer:
+    # serves graphs over HTTP, from a ChessGraph kept warm across requests.
+    # Explorations run one at a time, and identical concurrent requests share
+    # a single exploration.
+    formats = {
+        "svg": "image/svg+xml",
+        "dot": "text/vnd.graphviz",
+        "jsonl": "application/x-ndjson",
+        "graphml": "application/graphml+xml",
+    }
+
+    def __init__(self, chessgraph, defaults):
+        self.chessgraph = chessgraph
+        self.defaults = defaults
+        self.lock = threading.Lock()
+        self.explorelock = threading.Lock()
+        self.inflight = {}
+
+    def graph(self, params):
+        # returns the body and content type of the response, and its stats
+        params = {k: str(v) for k, v in dict(self.defaults, **params).items()}
+        for name, choices in [
+            ("format", self.formats),
+            ("boardstyle", ["unicode", "svg", "none"]),
+            ("networkstyle", ["graph", "tree"]),
+        ]:
+            if params[name] not in choices:
+                raise ValueError("invalid {}: {}".format(name, params[name]))
+        key = tuple(sorted(params.items()))
+
+        with self.lock:
+            pending = self.inflight.get(key)
+            coalesced = pending is not None
+            if not coalesced:
+                pending = self.inflight[key] = concurrent.futures.Future()
+
+        if coalesced:
+            body, stats = pending.result()
+            return body, self.formats[params["format"]], dict(stats, coalesced=True)
+
+        try:
+            with self.explorelock:
+                result = self.explore(params)
+        except Exception as e:
+            pending.set_exception(e)
+            raise
+        else:
+            pending.set_result(result)
+        finally:
+            with self.lock:
+                del self.inflight[key]
+
+        body, stats = result
+        return body, self.formats[params["format"]], dict(stats, coalesced=False)
+
+    def explore(self, params):
+        graph = self.chessgraph
+        if params.get("san"):
+            fen = chess.pgn.read_game(io.StringIO(params["san"])).end().board().fen()
+        else:
+            fen = chess.Board(params["position"]).fen()
+        graph.depth = int(params["depth"])
+        graph.boardstyle = params["boardstyle"]
+        graph.networkstyle = params["networkstyle"]
+
+        before = graph.stats.snapshot()
+        start = time.perf_counter()
+        graph.generate_graph(
+            fen, int(params["alpha"]), int(params["beta"]), None, None, None, None
+        )
+        rootkey, records = graph.written
+
+        if params["format"] == "svg":
+            body = graph.render(None, params.get("embed") == "1")
+        elif params["format"] == "dot":
+            body = graph.graph.source
+        else:
+            file = io.StringIO()
+            sink = (JsonLinesSink if params["format"] == "jsonl" else GraphMLSink)(file)
+            for kind, keys, priority, attrs, fields in records:
+                if kind == "node":
+                    sink.node(keys[0], fields, priority)
+                else:
+                    sink.edge(keys[0], keys[1], fields, priority)
+            sink.end()
+            body = file.getvalue()
+
+        after = graph.stats.snapshot()
+        stats = dict(
+            elapsed=time.perf_counter() - start,
+            nodes=after["nodes"] - before["nodes"],
+            queries=graph.budget.counts()[1],
+            cache={
+                source: dict(
+                    hits=after[source + ".cachehits"] - before[source + ".cachehits"],
+                    misses=after[source + ".cachemisses"]
+                    - before[source + ".cachemisses"],
+                )
+                for source in graph.sources
+            },
+        )
+        return body, stats
+
+
+class GraphRequestHandler(http.server.BaseHTTPRequestHandler):
+    # GET /graph?position=<fen>&depth=..&alpha=..&beta=..&format=svg, with the
+    # stats of the exploration in the X-Chessgraph-Stats header
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        url = parse.urlparse(self.path)
+        if url.path != "/graph":
+            self.respond(404, b"not found", "text/plain")
+            return
+        params = {k: v[-1] for k, v in parse.parse_qs(url.query).items()}
+        try:
+            body, contenttype, stats = self.server.graphserver.graph(params)
+        except ValueError as e:
+            self.respond(400, str(e).encode("utf-8"), "text/plain")
+            return
+        except Exception as e:
+            self.respond(500, repr(e).encode("utf-8"), "text/plain")
+            return
+        self.respond(200, body.encode("utf-8"), contenttype, stats)
+
+    def respond(self, status, body, contenttype, stats=None):
+        self.send_response(status)
+        self.send_header("Content-Type", contenttype)
+        self.send_header("Content-Length", str(len(body)))
+        if stats is not None:
+            self.send_header("X-Chessgraph-Stats", json.dumps(stats))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class UnixHTTPServer(http.server.ThreadingHTTPServer):
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        socketserver.TCPServer.server_bind(self)
+        self.server_name = "localhost"
+        self.server_port = 0
+
+
+def serve(graphserver, address):
+    # address is [host:]port, or the path of a Unix socket
+    if "/" in address:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(address)
+        server = UnixHTTPServer(address, GraphRequestHandler)
+    else:
+        host, _, port = address.rpartition(":")
+        server = http.server.ThreadingHTTPServer(
+            (host or "127.0.0.1", int(port)), GraphRequestHandler
+        )
+    server.daemon_threads = True
+    server.graphserver = graphserver
+    print("serving graphs on", address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+# the graph of a worker process, exploring the subtrees it is given
+subtreegraph = None
+
+
+def init_subtree_process(options, cachefile, tt, budget):
+    global subtreegraph
+    subtreegraph = ChessGraph(**options)
+    if cachefile is not None:
+        subtreegraph.cache = PositionCache(cachefile)
+    subtreegraph.tt = tt
+    subtreegraph.budget = budget
+    subtreegraph.roots = None
+    multiprocessing.util.Finalize(None, subtreegraph.close, exitpriority=10)
+
+
+def analyse_in_process(epd):
+    # the moves of a position scored by the engines of a worker process, for
+    # the plies explored by the main process
+    moves = subtreegraph.get_moves_engine(epd)
+    return moves, subtreegraph.stats.take()
+
+
+def explore_subtree(state):
+    # returns the records of the nodes and edges of the subtree, with their
+    # expansions and the counters of the work done
+    (
+        key,
+        poskey,
+        history,
+        board,
+        depth,
+        alpha,
+        beta,
+        pvNode,
+        plyFromRoot,
+        edgescore,
+        path,
+        roots,
+        checkpoint,
+        networkstyle,
+        boardstyle,
+    ) = state
+    # the expansions of a resumed checkpoint are loaded for each root
+    if roots != subtreegraph.roots:
+        subtreegraph.roots = roots
+        subtreegraph.expansions = {}
+        if checkpoint is not None:
+            with open(checkpoint, "rb") as f:
+                subtreegraph.expansions = pickle.load(f)["expansions"]
+    # the styles of the graph can change between roots (see GraphServer)
+    subtreegraph.networkstyle = networkstyle
+    subtreegraph.boardstyle = boardstyle
+    subtreegraph.history = history
+    node = Node(
+        key,
+        poskey,
+        board,
+        depth,
+        alpha,
+        beta,
+        pvNode,
+        plyFromRoot,
+        None,
+        edgescore,
+        path,
+    )
+    subtreegraph.run(subtreegraph.explore(node))
+    records, subtreegraph.records = subtreegraph.records, []
+    expansions = {}
+    if subtreegraph.iterative or subtreegraph.checkpoint is not None:
+        expansions = {
+            keys[0]: subtreegraph.expansions[keys[0]]
+            for kind, keys, priority, attrs, fields in records
+            if kind == "node" and keys[0] in subtreegraph.expansions
+        }
+    return records, expansions, subtreegraph.stats.take()
+
+
+def source_cascade(value):
+    names = []
+    for tier in value.split(","):
+        name, _, limit = tier.partition(":")
+        if name not in ["chessdb", "lichess", "engine", "book"] or name in names:
+            raise argparse.ArgumentTypeError("invalid source tier: " + tier)
+        if limit and not (limit.isdigit() and int(limit) > 0):
+            raise argparse.ArgumentTypeError("invalid tier concurrency: " + tier)
+        names.append(name)
+    return value
+
+
+def export_file(value):
+    if not value.endswith((".jsonl", ".graphml")):
+        raise argparse.ArgumentTypeError("unknown export format: " + value)
+    return value
+
+
+def read_batch(filename):
+    # the roots of a batch: the final positions of the games of a PGN file,
+    # the positions of an EPD file, or else the moves of a line in SAN notation
+    fens = []
+    with open(filename, encoding="utf-8") as f:
+        if filename.endswith(".pgn"):
+            while (game := chess.pgn.read_game(f)) is not None:
+                fens.append(game.end().board().fen())
+            return fens
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if filename.endswith(".epd"):
+                fens.append(chess.Board.from_epd(line)[0].fen())
+            else:
+                fens.append(chess.pgn.read_game(io.StringIO(line)).end().board().fen())
+    return fens
+
+
+def batch_filename(filename, index):
+    # the file of a root of a batch, numbered from 1 (e.g. chess-3.svg)
+    if filename is None:
+        return None
+    root, ext = os.path.splitext(filename)
+    return "{}-{}{}".format(root, index, ext)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
@@ -496,6 +3096,12 @@ if __name__ == "__main__":
         "--san",
         help='Moves in SAN notation that lead to the root position. E.g. "1. g4".',
     )
+    group.add_argument(
+        "--batch",
+        type=str,
+        help="File of root positions, explored one after the other sharing caches, connections and engines: the final positions of the games of a .pgn file, "
+        "the positions of an .epd file, or otherwise one line of SAN moves per root. The --output, --export and --checkpoint files of each root are numbered, e.g. chess-1.svg.",
+    )
 
     groupa = parser.add_mutually_exclusive_group()
     groupa.add_argument(
@@ -549,10 +3155,11 @@ if __name__ == "__main__":
 
     parser.add_argument(
         "--source",
-        choices=["chessdb", "lichess", "engine"],
-        type=str,
+        type=source_cascade,
         default="chessdb",
-        help="Use chessdb, lichess or an engine to score and rank moves.",
+        help="Use chessdb, lichess, an engine or a book (see --indexbook) to score and rank moves. "
+        "A comma separated cascade (e.g. chessdb,engine:4) falls back to the next source for positions "
+        "the previous one cannot score, with an optional concurrency limit per source.",
     )
 
     parser.add_argument(
@@ -563,6 +3170,34 @@ if __name__ == "__main__":
         help="Which lichess database to access: masters, or lichess players.",
     )
 
+    parser.add_argument(
+        "--book",
+        type=str,
+        default="chessgraph.book.db",
+        help="Index of the games of the book.",
+    )
+
+    parser.add_argument(
+        "--bookmingames",
+        type=int,
+        default=10,
+        help="Minimum number of games of the book for a move to be considered.",
+    )
+
+    parser.add_argument(
+        "--indexbook",
+        type=str,
+        nargs="+",
+        help="Add the games of PGN files or Polyglot books (.bin) to the book, and exit. Files already indexed are skipped, games appended to PGN files since added.",
+    )
+
+    parser.add_argument(
+        "--bookplies",
+        type=int,
+        default=40,
+        help="Number of plies of each game added to the book.",
+    )
+
     parser.add_argument(
         "--engine",
         type=str,
@@ -572,6 +3207,48 @@ if __name__ == "__main__":
         help="Name of the engine binary (with path as needed).",
     )
 
+    parser.add_argument(
+        "--http2",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="Use HTTP/2 for the remote sources (requires the h2 package).",
+    )
+
+    parser.add_argument(
+        "--chessdburl",
+        type=str,
+        default="http://www.chessdb.cn/cdb.php",
+        help="URL of the chessdb API (e.g. a local mirror or mock server).",
+    )
+
+    parser.add_argument(
+        "--lichessurl",
+        type=str,
+        default="https://explorer.lichess.ovh",
+        help="URL of the lichess opening explorer API.",
+    )
+
+    parser.add_argument(
+        "--ratelimit",
+        type=float,
+        default=50,
+        help="Maximum number of requests per second sent to a remote source, lowered automatically when the source throttles.",
+    )
+
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=5,
+        help="Number of retries (with exponential backoff) of a failed or throttled request to a remote source.",
+    )
+
+    parser.add_argument(
+        "--unknownttl",
+        type=float,
+        default=86400,
+        help="Time (in seconds) during which a position unknown to the remote source is not queried again.",
+    )
+
     parser.add_argument(
         "--enginedepth",
         type=int,
@@ -586,6 +3263,77 @@ if __name__ == "__main__":
         help="Maximum number of moves (MultiPV) considered by the engine in evaluation.",
     )
 
+    parser.add_argument(
+        "--enginethreads",
+        type=int,
+        help="Threads option passed to each engine of the pool (engine default if unset).",
+    )
+
+    parser.add_argument(
+        "--enginehash",
+        type=int,
+        help="Hash option (in MB) passed to each engine of the pool (engine default if unset).",
+    )
+
+    parser.add_argument(
+        "--maxnodes",
+        type=int,
+        help="Maximum number of nodes scored by the source. Once a limit is reached, the remaining nodes are scored by the edge leading to them.",
+    )
+
+    parser.add_argument(
+        "--maxqueries",
+        type=int,
+        help="Maximum number of queries sent to the source (requests or engine searches, not cache hits).",
+    )
+
+    parser.add_argument(
+        "--timelimit",
+        type=float,
+        help="Maximum time (in seconds) spent exploring.",
+    )
+
+    parser.add_argument(
+        "--iterative",
+        action="store_true",
+        help="Explore with increasing depth up to DEPTH, writing the output after each depth.",
+    )
+
+    parser.add_argument(
+        "--checkpoint",
+        type=str,
+        help="File in which the expanded nodes are saved after each depth, and from which a later run (e.g. at larger depth or with a wider window) resumes, expanding only new nodes.",
+    )
+
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=0,
+        help="Number of processes exploring the subtrees two plies below the root, sharing the concurrency.",
+    )
+
+    parser.add_argument(
+        "--prefetch",
+        type=int,
+        default=0,
+        help="Maximum number of speculative requests in flight, fetching the children within the window of a node as soon as its moves are known (remote sources only).",
+    )
+
+    parser.add_argument(
+        "--pvharvest",
+        type=int,
+        default=0,
+        help="Record the positions up to this many plies along the principal variations found by the engine as provisional cache entries, which then score leaves without a search.",
+    )
+
+    parser.add_argument(
+        "--leafeval",
+        choices=["search", "edge", "edgepv"],
+        type=str,
+        default="search",
+        help="Score leaves (nodes at depth 0) by querying the source (search), by the score of the edge leading to them (edge), or by the edge except for leaves on the principal variation (edgepv).",
+    )
+
     parser.add_argument(
         "--networkstyle",
         choices=["graph", "tree"],
@@ -617,22 +3365,143 @@ if __name__ == "__main__":
         help="Name of the output file (image in .svg format).",
     )
 
+    parser.add_argument(
+        "--stats",
+        type=str,
+        help="File to which a JSON report of the run is written: nodes per second, cache hit rates and latency histograms per source, queue depths, and time spent writing and laying out the graph.",
+    )
+
+    parser.add_argument(
+        "--progress",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="Show the progress of the exploration on stderr.",
+    )
+
+    parser.add_argument(
+        "--profile",
+        type=str,
+        help="File to which a cProfile profile of the exploration is written (see python -m pstats).",
+    )
+
+    parser.add_argument(
+        "--export",
+        action="append",
+        type=export_file,
+        help="File to which the nodes and edges are exported, in JSON Lines (.jsonl, streamed as they complete, a node possibly several times with the priority of each record) or GraphML (.graphml, written once exploration completes) format. Can be repeated.",
+    )
+
+    parser.add_argument(
+        "--layout",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="Lay out the graph with graphviz and write the --output image. Without layout, only the --export files are written, and the graph is not kept in memory.",
+    )
+
+    parser.add_argument(
+        "--serve",
+        type=str,
+        help="Serve graphs over HTTP at [host:]port, or at the path of a Unix socket, keeping caches and engines warm across requests. "
+        "GET /graph takes position or san, depth, alpha, beta, boardstyle, networkstyle, embed and format (svg, dot, jsonl or graphml), defaulting to the options given here, "
+        "and returns the stats of the exploration in the X-Chessgraph-Stats header.",
+    )
+
+    parser.add_argument(
+        "--merge",
+        type=str,
+        help="Name of an output file (image in .svg format) with a single graph of all the roots of a --batch.",
+    )
+
     parser.add_argument(
         "--embed",
         action=argparse.BooleanOptionalAction,
         default=False,
-        help="If the individual svg boards should be embedded in the final .svg image. Unfortunately URLs are not preserved.",
+        help="If the individual svg boards should be embedded in the final .svg image, sharing the definitions of pieces and boards.",
+    )
+
+    parser.add_argument(
+        "--boardcache",
+        type=str,
+        default="chessgraph.boards",
+        help="Directory storing the svg images of boards (see --boardstyle svg).",
+    )
+
+    parser.add_argument(
+        "--boardcachesize",
+        type=int,
+        default=100,
+        help="Size in MB above which the least recently used board images are evicted.",
+    )
+
+    parser.add_argument(
+        "--simplify",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="Collapse chains of nodes with a single edge in and out into one edge labelled with the sequence of moves, which speeds up the layout of large graphs.",
+    )
+
+    parser.add_argument(
+        "--layoutthreshold",
+        type=int,
+        default=5000,
+        help="Number of nodes above which graphs are laid out by --largelayout instead of dot.",
+    )
+
+    parser.add_argument(
+        "--largelayout",
+        choices=["sfdp", "twopi"],
+        type=str,
+        default="sfdp",
+        help="Graphviz layout engine for graphs larger than --layoutthreshold.",
     )
 
     parser.add_argument(
         "--purgecache",
         action=argparse.BooleanOptionalAction,
         default=False,
-        help="Do no use, and later overwrite, the cache file stored on disk (chessgraph.cache.pyc).",
+        help="Do no use, and clear, the cache file stored on disk.",
+    )
+
+    parser.add_argument(
+        "--cachefile",
+        type=str,
+        default="chessgraph.cache.db",
+        help="Name of the cache file (SQLite) storing the moves of positions already queried. An existing chessgraph.cache.pyc is migrated when the file is created.",
+    )
+
+    parser.add_argument(
+        "--migratecache",
+        type=str,
+        help="Import the entries of a cache file written by earlier versions (pickle) into the cache file, and exit.",
+    )
+
+    parser.add_argument(
+        "--compactcache",
+        action="store_true",
+        help="Remove failed lookups and expired unknown positions (see --unknownttl) from the cache file and reclaim unused space, and exit.",
+    )
+
+    parser.add_argument(
+        "--cacheinfo",
+        action="store_true",
+        help="Print the number and storage size of the move lists in the cache file, and exit.",
     )
 
     args = parser.parse_args()
 
+    if args.indexbook is not None:
+        book = BookIndex(args.book)
+        for filename in args.indexbook:
+            start = time.perf_counter()
+            size = book.index(filename, args.bookplies, args.concurrency)
+            print(
+                "indexed           :  {} ({} bytes in {:.2f}s)".format(
+                    filename, size, time.perf_counter() - start
+                )
+            )
+        book.close()
+        sys.exit(0)
+
     chessgraph = ChessGraph(
         networkstyle=args.networkstyle,
         depth=args.depth,
@@ -644,43 +3513,137 @@ if __name__ == "__main__":
         enginemaxmoves=args.enginemaxmoves,
         boardstyle=args.boardstyle,
         boardedges=args.boardedges,
+        enginethreads=args.enginethreads,
+        enginehash=args.enginehash,
+        http2=args.http2,
+        chessdburl=args.chessdburl,
+        lichessurl=args.lichessurl,
+        ratelimit=args.ratelimit,
+        retries=args.retries,
+        unknownttl=args.unknownttl,
+        leafeval=args.leafeval,
+        pvharvest=args.pvharvest,
+        prefetch=args.prefetch,
+        processes=args.processes,
+        book=args.book,
+        boardcache=args.boardcache,
+        boardcachesize=args.boardcachesize,
+        bookmingames=args.bookmingames,
+        maxnodes=args.maxnodes,
+        maxqueries=args.maxqueries,
+        timelimit=args.timelimit,
+        iterative=args.iterative,
+        checkpoint=args.checkpoint,
+        progress=args.progress,
+        profile=args.profile,
+        exports=args.export or [],
+        layout=args.layout,
+        simplify=args.simplify,
+        layoutthreshold=args.layoutthreshold,
+        largelayout=args.largelayout,
     )
 
-    # load previously computed nodes in a cache
-    if not args.purgecache:
-        chessgraph.load_cache()
+    # previously computed nodes are looked up on demand in the cache file
+    chessgraph.open_cache(args.cachefile, purge=args.purgecache)
 
-    if args.san is not None:
-        import chess.pgn, io
+    if args.migratecache is not None or args.compactcache or args.cacheinfo:
+        if args.migratecache is not None:
+            print("migrated entries  : ", chessgraph.cache.migrate(args.migratecache))
+        if args.compactcache:
+            size = os.path.getsize(args.cachefile)
+            print(
+                "removed entries   : ", chessgraph.cache.compact(chessgraph.unknownttl)
+            )
+            print("remaining entries : ", len(chessgraph.cache))
+            print(
+                "file size         :  {} -> {} bytes".format(
+                    size, os.path.getsize(args.cachefile)
+                )
+            )
+        if args.cacheinfo:
+            info = chessgraph.cache.info()
+            print("entries           : ", info["entries"])
+            print("move lists        : ", info["movelists"])
+            print("moves             : ", info["moves"])
+            print("stored bytes      : ", info["bytes"])
+            print(
+                "move list bytes   :  {} packed, {} as lists of dicts".format(
+                    info["packedbytes"], info["legacybytes"]
+                )
+            )
+        chessgraph.close()
+        sys.exit(0)
+
+    if args.serve is not None:
+        chessgraph.layout = True
+        defaults = dict(
+            position=args.position,
+            depth=args.depth,
+            alpha=args.alpha,
+            beta=args.beta,
+            boardstyle=args.boardstyle,
+            networkstyle=args.networkstyle,
+            format="svg",
+        )
+        serve(GraphServer(chessgraph, defaults), args.serve)
+        chessgraph.close()
+        sys.exit(0)
 
+    if args.batch is not None:
+        fens = read_batch(args.batch)
+    elif args.san is not None:
         if args.san:
             pgn = io.StringIO(args.san)
-            fen = chess.pgn.read_game(pgn).end().board().fen()
+            fens = [chess.pgn.read_game(pgn).end().board().fen()]
         else:
-            fen = chess.STARTING_FEN  # passing empty string to --san gives startpos
+            fens = [chess.STARTING_FEN]  # passing empty string to --san gives startpos
     else:
-        fen = args.position
-
-    # generate the content of the dotfile
-    chessgraph.generate_graph(
-        fen, args.alpha, args.beta, args.ralpha, args.rbeta, args.salpha, args.sbeta
-    )
-
-    # store updated cache
-    chessgraph.store_cache()
-
-    # generate the svg image (calls graphviz under the hood)
-    svgpiped = chessgraph.graph.pipe()
-
-    if args.embed:
-        # this embeds the images of the boards generated.
-        # Unfortunately, does remove the URLs that link to chessdb.
-        # probably some smarter manipulation directly on the xml
-        # would also allow to shrink the image size (each board embeds pieces etc.)
-        cairosvg.svg2svg(
-            bytestring=svgpiped,
-            write_to=args.output,
+        fens = [args.position]
+
+    # the graph of a root is rendered in the background, while the next root
+    # of a batch is explored
+    renderpool = concurrent.futures.ThreadPoolExecutor()
+    renders = []
+    written = []
+    exports, checkpoint = chessgraph.exports, chessgraph.checkpoint
+    for index, fen in enumerate(fens, 1):
+        output = args.output
+        if args.batch is not None:
+            output = batch_filename(args.output, index)
+            chessgraph.exports = [batch_filename(e, index) for e in exports]
+            chessgraph.checkpoint = batch_filename(checkpoint, index)
+
+        # generate the content of the dotfile
+        chessgraph.generate_graph(
+            fen,
+            args.alpha,
+            args.beta,
+            args.ralpha,
+            args.rbeta,
+            args.salpha,
+            args.sbeta,
+            render=(lambda: chessgraph.render(output, args.embed))
+            if args.layout
+            else None,
         )
-    else:
-        with open(args.output, "w", encoding="utf-8") as f:
-            f.write(svgpiped.decode("utf-8"))
+        if args.layout:
+            renders.append(
+                renderpool.submit(
+                    chessgraph.render, output, args.embed, chessgraph.rendering()
+                )
+            )
+            # the records of every root are only kept for the merged graph
+            if args.merge is not None:
+                written.append(chessgraph.written)
+
+    for render in renders:
+        render.result()
+    renderpool.shutdown()
+
+    chessgraph.report()
+    chessgraph.close()
+    if args.merge is not None and written:
+        chessgraph.write_merged(written)
+        chessgraph.render(args.merge, args.embed)
+    if args.stats is not None:
+        chessgraph.write_stats(args.stats)
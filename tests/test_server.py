@@ -0,0 +1,66 @@
+import sys
+from os.path import abspath, dirname, join
+
+import pytest
+
+ROOT = join(dirname(abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+sys.path.insert(0, join(ROOT, "bench"))
+
+from chessgraph import ChessGraph, GraphServer  # noqa: E402
+from mockserver import MockServer  # noqa: E402
+
+
+@pytest.fixture(scope="module")
+def mockserver():
+    server = MockServer(latency=0).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def request_dot(mockserver, processes, params):
+    chessgraph = ChessGraph(
+        networkstyle="graph",
+        depth=4,
+        concurrency=4,
+        source="chessdb",
+        lichessdb="masters",
+        engine="stockfish",
+        enginedepth=20,
+        enginemaxmoves=10,
+        boardstyle="none",
+        boardedges=3,
+        chessdburl=mockserver.url + "/cdb.php",
+        ratelimit=1000,
+        processes=processes,
+    )
+    chessgraph.layout = True
+    defaults = dict(
+        depth=4,
+        alpha=-60,
+        beta=60,
+        boardstyle="none",
+        networkstyle="graph",
+        format="dot",
+    )
+    server = GraphServer(chessgraph, defaults)
+    try:
+        body, contenttype, stats = server.graph(params)
+    finally:
+        chessgraph.close()
+    return body
+
+
+@pytest.mark.parametrize(
+    "params",
+    [
+        dict(san="1. e4", boardstyle="unicode"),
+        dict(san="1. d4", networkstyle="tree", depth=7, alpha=-150, beta=150),
+    ],
+)
+def test_server_styles_in_processes(mockserver, params):
+    # the styles of a request also apply to the subtrees explored by workers
+    single = request_dot(mockserver, 0, params)
+    multi = request_dot(mockserver, 2, params)
+    assert single == multi